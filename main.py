@@ -1,11 +1,22 @@
 import asyncio
+import contextlib
+import io
 import json
+import os
 import random
+import re
+import sqlite3
+import sys
+import threading
 import time
 import traceback
-from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import aiohttp
@@ -17,24 +28,149 @@ from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
     AiocqhttpMessageEvent,
 )
 
+# 可选依赖：存在时用于更快的数据序列化，缺失时回退到标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+# 多实例共享数据时使用文件锁（仅类 Unix 系统）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# 可选依赖：存在时可将配对结果渲染为图片卡片
+try:
+    from PIL import Image as PILImage, ImageDraw, ImageFont
+except ImportError:
+    PILImage = None
+# 可选依赖：存在时流式解析大群的成员列表，降低峰值内存
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # --------------- 路径配置 ---------------
 PLUGIN_DIR = Path(__file__).parent
+# 旧版单文件配对数据，启动时会迁移到按群分片的 pair_data/ 目录
 PAIR_DATA_PATH = PLUGIN_DIR / "pair_data.json"
+PAIR_DATA_DIR = PLUGIN_DIR / "pair_data"
+# 加权抽取使用的历史权重（按群分片）
+SELECTION_WEIGHTS_DIR = PLUGIN_DIR / "selection_weights"
+# 排行榜统计（按群分片）
+PAIR_STATS_DIR = PLUGIN_DIR / "pair_stats"
 COOLING_DATA_PATH = PLUGIN_DIR / "cooling_data.json"
 # 新增：手动黑名单存储
 USER_MANUAL_BLOCKED_PATH = PLUGIN_DIR / "user_manual_blocked_peer.json"
 BREAKUP_COUNT_PATH = PLUGIN_DIR / "breakup_counts.json"
 ADVANCED_ENABLED_PATH = PLUGIN_DIR / "advanced_enabled.json"
+# 数据结构版本标记，迁移完成后写入，避免每次启动重复迁移
+STATE_META_PATH = PLUGIN_DIR / "state_meta.json"
+# 配对历史（追加写入的 SQLite 数据库）
+PAIR_HISTORY_PATH = PLUGIN_DIR / "pair_history.db"
+# 导出可读 JSON 的目录
+EXPORT_DIR = PLUGIN_DIR / "export"
+# 管理员批量导入文件所在目录
+IMPORT_DIR = PLUGIN_DIR / "import"
 
 # --------------- 常量 ---------------
 # q群管家 全局屏蔽 QQ
 GLOBAL_EXCLUDE_QQ = "2854196310"
+# 当前数据结构版本
+SCHEMA_VERSION = 2
+# 从候选池随机抽取时，因黑名单/冷静期被拒绝的最大重试次数，超过后改为遍历候选池
+POOL_SAMPLE_ATTEMPTS = 16
+# 加权抽取时每个用户记录的最近伴侣数量
+RECENT_PARTNERS_KEPT = 5
+# 配对历史中表示“结成配对”的事件及其显示名称
+HISTORY_PAIR_EVENTS = {"draw": "抽取", "group_pair": "全群配对", "wish": "许愿", "rob": "强娶"}
+# 排行榜指标：命令参数 -> (指标键, 榜单名称)
+STATS_METRICS = {
+    "被牛": ("robbed", "被牛榜"),
+    "被甩": ("dumped", "被甩榜"),
+    "连续": ("streak", "连续配对榜（天）"),
+    "许愿": ("wished", "被许愿榜"),
+}
+# 每项指标保留的前 K 名
+STATS_TOP_K = 10
+# 配对名单每页显示的对数
+PAIR_LIST_PAGE_SIZE = 30
+# 成员列表响应超过该大小（或大小未知）时使用流式解析
+MEMBER_LIST_STREAM_THRESHOLD = 512 * 1024
+# 结果卡片缓存的最大数量（每张约数十 KB）
+CARD_CACHE_SIZE = 256
+# 名称格式化结果缓存的最大条数（按 (名称, 最大长度) 缓存）
+DISPLAY_NAME_CACHE_SIZE = 4096
+# 查询老婆回复缓存的最大条数，超出时丢弃最久未使用的一条
+REPLY_CACHE_SIZE = 2048
+# 超出频率限制且没有缓存回复可用时的提示（每次进入限流只提示一次）
+RATE_LIMITED_REPLY = "⏳ 操作太频繁，请稍后再试"
+# 数据清理每批处理的群数量，批与批之间让出事件循环
+COMPACT_BATCH_SIZE = 100
+# 加权分数衰减到该值以下、或伴侣降权恢复到 1 - 该值以上时视为已失效
+COMPACT_WEIGHT_EPSILON = 0.01
+# 工作集：后台换出检查的间隔
+WORKING_SET_SWEEP_SECONDS = 60
+# 多实例共享模式下写入冲突时的回复
+STATE_CONFLICT_REPLY = "⚠️ 数据刚被其他实例修改，请重试"
 
 
 # --------------- 数据结构 ---------------
+@lru_cache(maxsize=DISPLAY_NAME_CACHE_SIZE)
+def _format_name(name: str, max_len: int) -> str:
+    """去掉换行并按最大长度截断名称，结果按 (名称, 最大长度) 缓存"""
+    safe_name = name.replace("\n", "").replace("\r", "").strip()
+    return safe_name[:max_len] + "……" if len(safe_name) > max_len else safe_name
+
+
+def _split_display_info(raw_info: str, user_id: str = "") -> Tuple[str, str]:
+    """
+    把 "名称(QQ号)" 拆成 (名称, QQ号)。已知QQ号时按后缀精确去除；
+    否则只有最后一对括号内是纯数字时才视为QQ号，名称本身带括号也不会拆错。
+    """
+    if user_id and raw_info.endswith(f"({user_id})"):
+        return raw_info[:-len(user_id) - 2].strip(), user_id
+    name, sep, tail = raw_info.rpartition("(")
+    if sep and tail.endswith(")") and tail[:-1].isdigit():
+        return name.strip(), tail[:-1]
+    return raw_info.strip(), user_id
+
+
+def _partner_record(user_id: str, nickname: str, card: str = "") -> dict:
+    """伴侣记录：QQ号、昵称和群名片分开保存，显示时再组合"""
+    return {"user_id": user_id, "nickname": nickname, "card": card}
+
+
+def _partner_name(record: dict) -> str:
+    """伴侣记录的显示名称（优先群名片），兼容其他实例写入的旧版 display_name"""
+    name = record.get("card") or record.get("nickname")
+    if name is None and "display_name" in record:
+        name = _split_display_info(record["display_name"], record.get("user_id", ""))[0]
+    return name or ""
+
+
+def _display_info(record: dict) -> str:
+    """伴侣记录的完整显示信息 名称(QQ号)，用于配对历史和排行榜"""
+    return f"{_partner_name(record)}({record['user_id']})" if record.get("user_id") else ""
+
+
+def _upgrade_partner_record(record: dict) -> bool:
+    """把旧版 "名称(QQ号)" 形式的 display_name 拆分为 nickname / card，返回是否有修改"""
+    if "display_name" not in record:
+        return False
+    record["nickname"] = _split_display_info(record.pop("display_name"), record.get("user_id", ""))[0]
+    record.setdefault("card", "")
+    return True
+
+
 class GroupMember:
     """群成员数据类"""
 
+    __slots__ = ("user_id", "nickname", "card")
+
     def __init__(self, data: dict):
         self.user_id: str = str(data["user_id"])
         self.nickname: str = data.get("nickname", "")
@@ -45,6 +181,1098 @@ class GroupMember:
         """带QQ号的显示信息"""
         return f"{self.card or self.nickname}({self.user_id})"
 
+    def partner_record(self) -> dict:
+        return _partner_record(self.user_id, self.nickname, self.card)
+
+
+class MemberList:
+    """
+    群成员列表（列式存储）：只保留 user_id / nickname / card 三个字段，
+    user_id 以整数数组保存，按下标访问时才构造 GroupMember。
+    """
+
+    __slots__ = ("user_ids", "nicknames", "cards")
+
+    def __init__(self):
+        self.user_ids = array("q")
+        self.nicknames: List[str] = []
+        self.cards: List[str] = []
+
+    def append(self, data: dict) -> None:
+        if "user_id" not in data:
+            return
+        self.user_ids.append(int(data["user_id"]))
+        self.nicknames.append(data.get("nickname") or "")
+        self.cards.append(data.get("card") or "")
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __getitem__(self, index: int) -> GroupMember:
+        return GroupMember({"user_id": self.user_ids[index], "nickname": self.nicknames[index],
+                            "card": self.cards[index]})
+
+
+class TokenBucket:
+    """令牌桶：以 rate 个/秒的速度补充令牌，最多积攒 capacity 个，每次请求消耗一个"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """按键（用户或群）维护令牌桶；rate_per_minute <= 0 表示不限流。空闲（桶已满）的键会被定期清理。"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.burst = max(burst, 1)
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def allow(self, key: str) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= 4096:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full(now)}
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket.try_acquire(now)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class _StreamHead:
+    """包装异步字节流，记录最先读取到的 limit 字节，供流式解析没有得到任何条目时检查响应结构"""
+
+    __slots__ = ("stream", "limit", "head")
+
+    def __init__(self, stream, limit: int):
+        self.stream = stream
+        self.limit = limit
+        self.head = bytearray()
+
+    async def read(self, n: int = -1) -> bytes:
+        chunk = await self.stream.read(n)
+        if len(self.head) + len(chunk) <= self.limit:
+            self.head += chunk
+        return chunk
+
+
+class GroupWorkingSet:
+    """
+    最近活跃群的工作集，按最后访问时间排序（LRU）。
+    超出群数量上限时最久未访问的群、以及空闲超过时限的群被选为换出对象，
+    当前不能换出的群（仍有命令在处理中或有未保存的修改）被跳过，由后面的群补足。
+    """
+
+    __slots__ = ("max_groups", "idle_seconds", "_last_used")
+
+    def __init__(self, max_groups: int, idle_seconds: float):
+        self.max_groups = max(max_groups, 0)
+        self.idle_seconds = max(idle_seconds, 0)
+        self._last_used: Dict[str, float] = {}
+
+    def touch(self, group_id: str, now: Optional[float] = None) -> None:
+        self._last_used.pop(group_id, None)
+        self._last_used[group_id] = time.monotonic() if now is None else now
+
+    def discard(self, group_id: str) -> None:
+        self._last_used.pop(group_id, None)
+
+    def over_budget(self) -> bool:
+        return 0 < self.max_groups < len(self._last_used)
+
+    def victims(self, now: float, evictable: Callable[[str], bool]) -> List[str]:
+        """应换出的群，按最久未访问的顺序排列；evictable 返回 False 的群不会被选中"""
+        excess = len(self._last_used) - self.max_groups if self.max_groups else 0
+        victims = []
+        for group_id, last_used in self._last_used.items():
+            if excess <= 0 and not (self.idle_seconds and now - last_used >= self.idle_seconds):
+                break
+            if evictable(group_id):
+                victims.append(group_id)
+                excess -= 1
+        return victims
+
+    def __contains__(self, group_id) -> bool:
+        return group_id in self._last_used
+
+    def __len__(self) -> int:
+        return len(self._last_used)
+
+
+def _deep_sizeof(obj) -> int:
+    """估算对象及其引用的容器、字符串等占用的内存字节数，同一对象只计一次"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__slots__"):
+            stack.extend(getattr(item, name) for name in item.__slots__ if hasattr(item, name))
+        elif hasattr(item, "__dict__") and not isinstance(item, type):
+            stack.append(vars(item))
+    return total
+
+
+class IndexedSet:
+    """支持 O(1) 添加、删除（与末尾元素交换后弹出）和随机抽取的集合"""
+
+    __slots__ = ("_items", "_positions")
+
+    def __init__(self, items=()):
+        self._items: List[str] = []
+        self._positions: Dict[str, int] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: str) -> None:
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item: str) -> None:
+        pos = self._positions.pop(item, None)
+        if pos is None:
+            return
+        last = self._items.pop()
+        if pos < len(self._items):
+            self._items[pos] = last
+            self._positions[last] = pos
+
+    def choice(self) -> str:
+        return self._items[random.randrange(len(self._items))]
+
+    def __contains__(self, item) -> bool:
+        return item in self._positions
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class FenwickSampler:
+    """按权重随机抽取下标的树状数组：单点修改权重与抽取均为 O(log n)"""
+
+    __slots__ = ("_tree", "_weights")
+
+    def __init__(self, weights: List[float]):
+        self._weights = list(weights)
+        size = len(self._weights)
+        self._tree = [0.0] * (size + 1)
+        for i, weight in enumerate(self._weights, start=1):
+            self._tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+
+    def weight(self, index: int) -> float:
+        return self._weights[index]
+
+    def update(self, index: int, weight: float) -> None:
+        delta = weight - self._weights[index]
+        if not delta:
+            return
+        self._weights[index] = weight
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def total(self) -> float:
+        total = 0.0
+        i = len(self._weights)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def sample(self) -> Optional[int]:
+        """按权重抽取一个下标，总权重为 0 时返回 None"""
+        remaining = random.random() * self.total()
+        if remaining <= 0:
+            return None
+        pos = 0
+        step = 1 << (len(self._weights).bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= remaining:
+                pos = nxt
+                remaining -= self._tree[nxt]
+            step >>= 1
+        return min(pos, len(self._weights) - 1)
+
+
+class EligiblePool:
+    """
+    某群当天可被抽取的候选人：群成员中除去今日已使用/已配对的成员、机器人和全局排除的QQ。
+    配对、分手时增量更新；黑名单、冷静期等与请求者相关的条件在抽取时检查。
+    传入 weight_of 时额外维护按成员权重抽取的 FenwickSampler，不在候选池中的成员权重为 0。
+    """
+
+    def __init__(self, members: MemberList, group_data: Dict, bot_id: str,
+                 weight_of: Optional[Callable[[str], float]] = None):
+        self.members = members
+        self.date = group_data.get("date")
+        self.bot_id = bot_id
+        self.positions: Dict[str, int] = {str(uid): i for i, uid in enumerate(members.user_ids)}
+        unavailable = set(group_data.get("used", [])) | set(group_data.get("pairs", {}))
+        self.candidates = IndexedSet(uid for uid in self.positions
+                                     if uid not in unavailable and self._selectable(uid))
+        self.sampler: Optional[FenwickSampler] = None
+        self._base_weights: List[float] = []
+        if weight_of is not None:
+            self._base_weights = [weight_of(str(uid)) for uid in members.user_ids]
+            self.sampler = FenwickSampler([w if str(uid) in self.candidates else 0.0
+                                           for uid, w in zip(members.user_ids, self._base_weights)])
+
+    def _selectable(self, user_id: str) -> bool:
+        return user_id != self.bot_id and user_id != GLOBAL_EXCLUDE_QQ
+
+    def member(self, user_id: str) -> GroupMember:
+        return self.members[self.positions[user_id]]
+
+    def weight(self, user_id: str) -> float:
+        return self._base_weights[self.positions[user_id]] if self._base_weights else 1.0
+
+    def set_weight(self, user_id: str, weight: float) -> None:
+        """更新成员的基础权重，成员当前在候选池中时同步更新抽样器"""
+        pos = self.positions.get(user_id)
+        if self.sampler is None or pos is None:
+            return
+        self._base_weights[pos] = weight
+        if user_id in self.candidates:
+            self.sampler.update(pos, weight)
+
+    def remove(self, *user_ids: str) -> None:
+        for uid in map(str, user_ids):
+            self.candidates.discard(uid)
+            if self.sampler is not None and uid in self.positions:
+                self.sampler.update(self.positions[uid], 0.0)
+
+    def restore(self, *user_ids: str) -> None:
+        for uid in map(str, user_ids):
+            if uid in self.positions and self._selectable(uid):
+                self.candidates.add(uid)
+                if self.sampler is not None:
+                    self.sampler.update(self.positions[uid], self._base_weights[self.positions[uid]])
+
+
+class PairHistoryStore:
+    """
+    配对历史：配对、分手、许愿、强娶、锁定等事件追加写入 SQLite，
+    按 (群, 日期) 与 (群, 用户, 时间) 建立索引，查询时只读取需要的记录。
+    连接可在多个线程中使用（调用方通过 asyncio.to_thread 访问），内部加锁串行化。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    partner_id TEXT NOT NULL,
+                    user_name TEXT,
+                    partner_name TEXT,
+                    detail TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_group_day ON history (group_id, day);
+                CREATE INDEX IF NOT EXISTS idx_history_group_user ON history (group_id, user_id, ts);
+                CREATE INDEX IF NOT EXISTS idx_history_group_partner ON history (group_id, partner_id, ts);
+            """)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def append(self, rows: List[Tuple]) -> None:
+        """写入 (ts, day, group_id, event, user_id, partner_id, user_name, partner_name, detail) 记录"""
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO history (ts, day, group_id, event, user_id, partner_id, user_name, partner_name, detail)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def recent_partners(self, group_id: str, user_id: str, limit: int) -> List[Tuple[float, str, str, str]]:
+        """用户在该群最近结成的配对，返回 [(ts, event, 伴侣QQ, 伴侣名称)]，最新的在前"""
+        events = tuple(HISTORY_PAIR_EVENTS)
+        placeholders = ",".join("?" * len(events))
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT ts, event, partner_id, partner_name FROM history"
+                f" WHERE group_id = ? AND user_id = ? AND event IN ({placeholders})"
+                f" UNION ALL "
+                f"SELECT ts, event, user_id, user_name FROM history"
+                f" WHERE group_id = ? AND partner_id = ? AND event IN ({placeholders})"
+                f" ORDER BY ts DESC LIMIT ?",
+                (group_id, user_id, *events, group_id, user_id, *events, limit)).fetchall()
+
+    def events_on(self, group_id: str, day: str) -> List[Tuple]:
+        """某群某天的所有事件，按时间排序"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ts, event, user_id, partner_id, user_name, partner_name, detail FROM history"
+                " WHERE group_id = ? AND day = ? ORDER BY ts", (group_id, day)).fetchall()
+
+    def prune(self, before_day: str) -> int:
+        """删除早于 before_day 的记录，返回删除条数"""
+        with self._lock:
+            with self._conn:
+                return self._conn.execute("DELETE FROM history WHERE day < ?", (before_day,)).rowcount
+
+
+class StateSerializer:
+    """
+    数据文件序列化器，storage_format 可选：
+    - json: 标准库 json，带缩进，便于人工查看（旧版格式）
+    - compact: 紧凑 JSON，安装了 orjson 时使用 orjson
+    - msgpack: 二进制格式，需安装 msgpack，未安装时回退为 compact
+    读取时根据文件内容自动识别格式，切换格式后旧文件仍可正常读取。
+    """
+
+    FORMATS = ("json", "compact", "msgpack")
+
+    def __init__(self, fmt: str = "compact"):
+        if fmt not in self.FORMATS:
+            logger.warning(f"⚠️ 未知的存储格式 {fmt}，已改用 compact")
+            fmt = "compact"
+        if fmt == "msgpack" and msgpack is None:
+            logger.warning("⚠️ 未安装 msgpack，存储格式回退为 compact")
+            fmt = "compact"
+        self.format = fmt
+
+    def dumps(self, data) -> bytes:
+        if self.format == "msgpack":
+            return msgpack.packb(data, use_bin_type=True)
+        if self.format == "compact":
+            if orjson is not None:
+                return orjson.dumps(data)
+            return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    @staticmethod
+    def loads(raw: bytes):
+        head = raw.lstrip()[:1]
+        if head in (b"{", b"["):
+            return _json_loads(raw)
+        if not head:
+            raise ValueError("数据文件为空")
+        if msgpack is None:
+            raise ValueError("数据文件不是 JSON 格式，且未安装 msgpack 无法解析")
+        return msgpack.unpackb(raw, raw=False)
+
+
+def _json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+
+
+def _onebot_id(value):
+    """OneBot 客户端要求 QQ号/群号为整数，无法转换时原样传递"""
+    return int(value) if str(value).isdigit() else value
+
+
+def _read_state_file(path: Path):
+    """读取数据文件，自动识别 JSON / msgpack 格式"""
+    return StateSerializer.loads(path.read_bytes())
+
+
+def _write_state_file(path: Path, data, serializer: StateSerializer) -> None:
+    """先写临时文件再替换，避免写入中途失败损坏原文件"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_bytes(serializer.dumps(data))
+    temp_path.replace(path)
+
+
+class OneBotWebSocket:
+    """
+    到单个 NapCat 的 OneBot v11 WebSocket 持久连接。并发的 API 调用共用一条连接，通过 echo 区分各自的响应；
+    连接失败后按指数退避重连，退避期间调用立即失败，由调用方改用 HTTP 或下一个主机。
+    """
+
+    def __init__(self, url: str, token: str = "", max_backoff: float = 60):
+        self.url = url
+        self.token = token
+        self.max_backoff = max_backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._reader: Optional[asyncio.Task] = None
+        # 当前连接上等待响应的调用 {echo: future}，每条连接一个，断开时只让该连接上的调用失败
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._connect_lock = asyncio.Lock()
+        self._echo = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self.stats: Dict[str, int] = {"calls": 0, "timeouts": 0, "connects": 0, "disconnects": 0}
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    async def _ensure_connected(self):
+        if self.connected:
+            return
+        async with self._connect_lock:
+            if self.connected:
+                return
+            if time.monotonic() < self._retry_at:
+                raise ConnectionError(f"{self.url} 正在等待重连")
+            if self._session is None or self._session.closed:
+                self._session = aiohttp.ClientSession()
+            headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+            try:
+                ws = await self._session.ws_connect(self.url, headers=headers, heartbeat=30, max_msg_size=0)
+            except Exception as e:
+                self._failures += 1
+                self._retry_at = time.monotonic() + min(2 ** self._failures, self.max_backoff)
+                raise ConnectionError(f"连接 {self.url} 失败: {e}") from e
+            self._failures = 0
+            self.stats["connects"] += 1
+            self._ws, self._pending = ws, {}
+            self._reader = asyncio.create_task(self._read_loop(ws, self._pending))
+
+    async def _read_loop(self, ws: aiohttp.ClientWebSocketResponse, pending: Dict[str, asyncio.Future]):
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    data = _json_loads(msg.data)
+                except ValueError:
+                    continue
+                # 通用端点还会推送事件，没有匹配 echo 的消息直接忽略
+                future = pending.pop(str(data.get("echo")), None) if isinstance(data, dict) else None
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except Exception:
+            logger.error(f"读取 {self.url} 消息失败: {traceback.format_exc()}")
+        finally:
+            self.stats["disconnects"] += 1
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"{self.url} 连接已断开"))
+            pending.clear()
+            if self._ws is ws:
+                self._ws = None
+
+    async def call(self, action: str, params: Dict, timeout: float) -> Dict:
+        """发送一次 API 调用并等待对应 echo 的响应，超时抛出 asyncio.TimeoutError"""
+        await self._ensure_connected()
+        self._echo += 1
+        echo = f"dailywife-{self._echo}"
+        pending = self._pending
+        future = asyncio.get_running_loop().create_future()
+        pending[echo] = future
+        self.stats["calls"] += 1
+        try:
+            await self._ws.send_str(json.dumps({"action": action, "params": params, "echo": echo}))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        finally:
+            pending.pop(echo, None)
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+
+class StateWriter:
+    """
+    数据文件的后台写入器。序列化由调用方在事件循环中完成（保证写入的是提交时刻的快照），
+    写临时文件、fsync 和原子替换在专用 I/O 线程池中执行，不阻塞事件循环。
+    同一文件的写入按提交顺序串行执行；排队中尚未开始的写入会被同一文件更新的内容直接替换。
+    """
+
+    def __init__(self, max_workers: int = 2, fsync: bool = True):
+        self.fsync = fsync
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dailywife-io")
+        # 每个文件等待执行的写入 [类型, 内容或函数, future] 与负责执行的任务
+        self._queues: Dict[Path, List[list]] = {}
+        self._workers: Dict[Path, asyncio.Task] = {}
+        # 写入指标（次数、字节数、各阶段累计耗时 ms），I/O 线程中也会更新
+        self.stats: Dict[str, float] = {}
+        self._stats_lock = threading.Lock()
+
+    def _stat(self, name: str, value: float = 1):
+        with self._stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def dumps(self, serializer: StateSerializer, data) -> bytes:
+        start = time.perf_counter()
+        payload = serializer.dumps(data)
+        self._stat("serialize_ms", (time.perf_counter() - start) * 1000)
+        return payload
+
+    def write_file(self, path: Path, payload: Optional[bytes]) -> None:
+        """在 I/O 线程中执行：写临时文件并 fsync 后原子替换；payload 为 None 时删除文件"""
+        if payload is None:
+            path.unlink(missing_ok=True)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        start = time.perf_counter()
+        with open(temp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            written = time.perf_counter()
+            if self.fsync:
+                os.fsync(f.fileno())
+        synced = time.perf_counter()
+        temp_path.replace(path)
+        self._stat("writes")
+        self._stat("write_bytes", len(payload))
+        self._stat("write_ms", (written - start) * 1000)
+        self._stat("fsync_ms", (synced - written) * 1000)
+
+    def write(self, path: Path, payload: Optional[bytes]) -> asyncio.Future:
+        """提交写入（payload 为 None 表示删除），返回写入完成时结束的 future，不需要确认时可以不等待"""
+        queue = self._queues.get(path)
+        if queue and queue[-1][0] == "write":
+            queue[-1][1] = payload
+            self._stat("coalesced")
+            return queue[-1][2]
+        return self._enqueue(path, ["write", payload])
+
+    def call(self, path: Path, func: Callable):
+        """在该文件的写入队列中（I/O 线程）执行 func，用于需要加锁检查后再写入的情况，future 返回 func 的结果"""
+        return self._enqueue(path, ["call", func])
+
+    def pending(self, path: Path) -> bool:
+        return path in self._workers
+
+    def _enqueue(self, path: Path, item: list) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # 失败已在写入任务中记录日志，不等待的调用方无需再取出异常
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        item.append(future)
+        self._queues.setdefault(path, []).append(item)
+        if path not in self._workers:
+            self._workers[path] = asyncio.create_task(self._drain_path(path))
+        return future
+
+    async def _drain_path(self, path: Path):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[path]
+        try:
+            while queue:
+                kind, arg, future = queue.pop(0)
+                try:
+                    if kind == "write":
+                        result = await loop.run_in_executor(self._executor, self.write_file, path, arg)
+                    else:
+                        result = await loop.run_in_executor(self._executor, arg)
+                except StateConflictError as e:
+                    future.set_exception(e)
+                except Exception as e:
+                    self._stat("failures")
+                    logger.error(f"写入 {path.name} 失败: {traceback.format_exc()}")
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            del self._workers[path]
+            self._queues.pop(path, None)
+
+    async def drain(self):
+        """等待所有已提交的写入完成"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class StateConflictError(Exception):
+    """多实例共享模式下，数据在本实例读取之后已被其他实例修改，本次写入被放弃"""
+
+    def __init__(self, keys: List[str]):
+        super().__init__(f"数据已被其他实例修改: {', '.join(keys)}")
+        self.keys = keys
+
+
+def _file_token(path: Path) -> Optional[Tuple[int, int, int]]:
+    """数据文件的版本标识：每次原子替换都会产生新的 inode 和修改时间，文件不存在时为 None"""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class FileLock:
+    """基于 fcntl.flock 的跨进程文件锁，锁文件与数据文件位于同一目录"""
+
+    def __init__(self, path: Path):
+        self.lock_path = path.with_name(path.name + ".lock")
+        self._file = None
+
+    def __enter__(self):
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.lock_path, "a+")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class GroupShardStore:
+    """
+    按群分片存储的数据：每个群一个文件，另有 index.json 记录所有群及其日期。
+    分片在首次访问时才加载，保存时只写入被修改过的群，写入开销只与活跃群的数据量有关。
+
+    shared=True 时支持多个实例共用同一目录：读取不加锁，通过 refresh 比较文件版本标识发现其他实例的修改；
+    写入时在该分片的文件锁内确认文件自本实例读取后未被修改（乐观并发），否则放弃写入并抛出 StateConflictError。
+    正在处理命令的群通过 pin 固定：refresh 不会丢弃其内存副本，处理中持有的数据在保存时仍是常驻的那一份。
+    """
+
+    def __init__(self, directory: Path, serializer: StateSerializer, shared: bool = False):
+        self.directory = directory
+        self.serializer = serializer
+        self.shared = shared
+        self.index_path = directory / "index.json"
+        self._index: Dict[str, Dict] = {}
+        self._index_token = None
+        # 本实例尚未写入索引文件的修改，None 表示删除
+        self._index_pending: Dict[str, Optional[Dict]] = {}
+        self._groups: Dict[str, Dict] = {}
+        self._tokens: Dict[str, Optional[Tuple[int, int, int]]] = {}
+        self._dirty: set = set()
+        self._deleted: set = set()
+        # 共享模式下正在写入的群，写入完成前 refresh 不会丢弃它们
+        self._writing: set = set()
+        # 正在处理命令的群及其引用计数
+        self._pins: Dict[str, int] = {}
+        # 从磁盘加载分片的次数（包括换出后重新加载）
+        self.loads = 0
+
+    def _shard_path(self, group_id: str) -> Path:
+        return self.directory / f"{group_id}.json"
+
+    def load(self, legacy_path: Optional[Path] = None) -> None:
+        """读取索引；若存在旧版单文件数据且尚未迁移，则拆分为分片。"""
+        if legacy_path is not None and legacy_path.exists() and not self.index_path.exists():
+            self._migrate_legacy(legacy_path)
+            return
+        try:
+            self._index = self._read_index()
+        except Exception:
+            logger.error(f"配对数据索引加载失败，将根据分片文件重建: {traceback.format_exc()}")
+            self._index = self._rebuild_index()
+            self._index_pending.update(self._index)
+
+    def _rebuild_index(self) -> Dict[str, Dict]:
+        """逐个读取分片文件中的日期重建索引；无法读取的分片记为无日期（清理时不会被当作过期删除）"""
+        index = {}
+        for path in self.directory.glob("*.json"):
+            if path == self.index_path:
+                continue
+            try:
+                day = _read_state_file(path).get("date")
+            except Exception:
+                logger.error(f"群 {path.stem} 分片读取失败，索引中不记录日期: {traceback.format_exc()}")
+                day = None
+            index[path.stem] = {"date": day} if day else {}
+        return index
+
+    def _read_index(self) -> Dict[str, Dict]:
+        self._index_token = _file_token(self.index_path)
+        if self._index_token is None:
+            return {}
+        return _read_state_file(self.index_path).get("groups", {})
+
+    def _migrate_legacy(self, legacy_path: Path) -> None:
+        legacy = _read_state_file(legacy_path)
+        for group_id, group_data in legacy.items():
+            self[str(group_id)] = group_data
+        self.flush()
+        legacy_path.replace(legacy_path.with_suffix(".json.bak"))
+        logger.info(f"✅ 已将 {legacy_path.name} 迁移为 {len(legacy)} 个群分片，原文件已备份为 .bak")
+
+    def _load_shard(self, group_id: str) -> Dict:
+        path = self._shard_path(group_id)
+        # 先记录版本再读取：若读取期间被替换，下次写入会按冲突处理，不会覆盖对方的修改
+        self._tokens[group_id] = _file_token(path)
+        try:
+            return _read_state_file(path)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            logger.error(f"群 {group_id} 配对数据加载失败: {traceback.format_exc()}")
+            return {}
+
+    def refresh(self, group_id: Optional[str] = None) -> List[str]:
+        """
+        共享模式下检查其他实例的修改：索引变化时重新读取索引（保留本实例未写入的修改），
+        已加载且未修改、未被固定的分片（传入 group_id 时只检查该群）若文件版本变化则丢弃内存副本，下次访问时重新加载。
+        被固定的分片保留内存副本，处理中的修改在写入时按冲突处理。
+        返回被刷新的群号列表。
+        """
+        if not self.shared:
+            return []
+        changed = []
+        if _file_token(self.index_path) != self._index_token:
+            index = self._read_index()
+            for gid, entry in self._index_pending.items():
+                if entry is None:
+                    index.pop(gid, None)
+                else:
+                    index[gid] = entry
+            self._index = index
+        for gid in ([group_id] if group_id is not None else list(self._groups)):
+            if gid in self._groups and gid not in self._dirty and gid not in self._writing and \
+                    gid not in self._pins and _file_token(self._shard_path(gid)) != self._tokens.get(gid):
+                del self._groups[gid]
+                changed.append(gid)
+        return changed
+
+    def __contains__(self, group_id) -> bool:
+        return group_id in self._groups or group_id in self._index
+
+    def __getitem__(self, group_id: str) -> Dict:
+        if group_id not in self._groups:
+            if group_id not in self._index:
+                raise KeyError(group_id)
+            self._groups[group_id] = self._load_shard(group_id)
+            self.loads += 1
+        return self._groups[group_id]
+
+    def __setitem__(self, group_id: str, group_data: Dict) -> None:
+        if group_id not in self._tokens:
+            self._tokens[group_id] = _file_token(self._shard_path(group_id)) if group_id in self._index else None
+        self._groups[group_id] = group_data
+        self._deleted.discard(group_id)
+        self.mark_dirty(group_id)
+
+    def __delitem__(self, group_id: str) -> None:
+        if group_id not in self:
+            raise KeyError(group_id)
+        self._groups.pop(group_id, None)
+        self._index.pop(group_id, None)
+        self._index_pending[group_id] = None
+        self._dirty.discard(group_id)
+        self._deleted.add(group_id)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, group_id: str, default=None):
+        return self[group_id] if group_id in self else default
+
+    def keys(self) -> List[str]:
+        return list(self._index.keys())
+
+    def loaded_keys(self) -> List[str]:
+        """已加载到内存中的群，遍历它们不会产生磁盘读取"""
+        return list(self._groups.keys())
+
+    def is_loaded(self, group_id: str) -> bool:
+        return group_id in self._groups
+
+    def read_unloaded(self, group_id: str) -> Dict:
+        """直接读取未加载群的分片文件，结果不放入内存缓存（用于导出等一次性遍历，应在线程中调用）"""
+        try:
+            return _read_state_file(self._shard_path(group_id))
+        except FileNotFoundError:
+            return {}
+
+    def date_of(self, group_id: str) -> Optional[str]:
+        """索引中记录的群数据日期，不需要加载分片"""
+        return self._index.get(group_id, {}).get("date")
+
+    def shard_size(self, group_id: str) -> int:
+        try:
+            return self._shard_path(group_id).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def clear(self) -> None:
+        for group_id in self.keys():
+            del self[group_id]
+
+    def evictable(self, group_id: str, writer: Optional[StateWriter] = None) -> bool:
+        """分片未被固定、没有未保存的修改、也没有正在进行或排队中的写入时才能换出"""
+        return group_id not in self._pins and group_id not in self._dirty and group_id not in self._writing and \
+            (writer is None or not writer.pending(self._shard_path(group_id)))
+
+    def evict(self, group_id: str) -> None:
+        """丢弃分片的内存副本，下次访问时从磁盘重新加载（调用前应确认 evictable）"""
+        if self._groups.pop(group_id, None) is not None:
+            self._tokens.pop(group_id, None)
+
+    def pin(self, group_id: str) -> None:
+        self._pins[group_id] = self._pins.get(group_id, 0) + 1
+
+    def unpin(self, group_id: str) -> None:
+        count = self._pins.pop(group_id, 0) - 1
+        if count > 0:
+            self._pins[group_id] = count
+
+    def mark_dirty(self, group_id: str) -> None:
+        if group_id not in self._groups:
+            if group_id in self._deleted:
+                return
+            # 内存副本已被丢弃（其他实例修改或换出），调用方持有的数据已不是常驻的那一份，修改无法保存
+            raise StateConflictError([group_id])
+        self._dirty.add(group_id)
+        date = self._groups[group_id].get("date")
+        if group_id not in self._index or self._index[group_id].get("date") != date:
+            self._index[group_id] = self._index_pending[group_id] = {"date": date}
+
+    def _write_shard(self, group_id: str) -> bool:
+        path = self._shard_path(group_id)
+        if not self.shared:
+            _write_state_file(path, self._groups[group_id], self.serializer)
+            return True
+        with FileLock(path):
+            if _file_token(path) != self._tokens.get(group_id):
+                return False
+            _write_state_file(path, self._groups[group_id], self.serializer)
+            self._tokens[group_id] = _file_token(path)
+        return True
+
+    def _write_index(self) -> None:
+        if not self.shared:
+            _write_state_file(self.index_path, {"groups": self._index}, self.serializer)
+            return
+        with FileLock(self.index_path):
+            if _file_token(self.index_path) != self._index_token:
+                # 索引只记录群号与日期，可以直接合并其他实例的修改
+                index = _read_state_file(self.index_path).get("groups", {}) if self.index_path.exists() else {}
+                for gid, entry in self._index_pending.items():
+                    if entry is None:
+                        index.pop(gid, None)
+                    else:
+                        index[gid] = entry
+                self._index = index
+            _write_state_file(self.index_path, {"groups": self._index}, self.serializer)
+            self._index_token = _file_token(self.index_path)
+
+    def flush(self) -> None:
+        """写入所有被修改的分片，删除被移除群的分片文件，必要时更新索引。共享模式下发生冲突的群最后统一抛出。"""
+        conflicts = []
+        for group_id in list(self._dirty):
+            self._dirty.discard(group_id)
+            if group_id in self._groups and not self._write_shard(group_id):
+                conflicts.append(group_id)
+                del self._groups[group_id]
+                self._index_pending.pop(group_id, None)
+        for group_id in list(self._deleted):
+            self._shard_path(group_id).unlink(missing_ok=True)
+            self._tokens.pop(group_id, None)
+            self._deleted.discard(group_id)
+        if self._index_pending:
+            self._write_index()
+            self._index_pending.clear()
+        if conflicts:
+            raise StateConflictError(conflicts)
+
+    def _write_shard_guarded(self, writer: StateWriter, group_id: str, payload: bytes) -> None:
+        """在 I/O 线程中执行：文件锁内确认分片版本未变后写入"""
+        path = self._shard_path(group_id)
+        with FileLock(path):
+            if _file_token(path) != self._tokens.get(group_id):
+                raise StateConflictError([group_id])
+            writer.write_file(path, payload)
+            self._tokens[group_id] = _file_token(path)
+
+    def _write_index_merged(self, writer: StateWriter, pending: Dict[str, Optional[Dict]]) -> Tuple[Dict, tuple]:
+        """在 I/O 线程中执行：文件锁内读取最新索引，合并本实例的修改后写入"""
+        with FileLock(self.index_path):
+            index = _read_state_file(self.index_path).get("groups", {}) if self.index_path.exists() else {}
+            for gid, entry in pending.items():
+                if entry is None:
+                    index.pop(gid, None)
+                else:
+                    index[gid] = entry
+            writer.write_file(self.index_path, self.serializer.dumps({"groups": index}))
+            return index, _file_token(self.index_path)
+
+    async def flush_async(self, writer: StateWriter) -> None:
+        """
+        与 flush 相同，但序列化后交给 writer 在 I/O 线程中写入。
+        非共享模式下提交后立即返回（同一文件的写入保持顺序）；共享模式下等待分片写入完成以确认是否冲突。
+        """
+        checks, writing = [], []
+        for group_id in list(self._dirty):
+            self._dirty.discard(group_id)
+            if group_id not in self._groups:
+                continue
+            payload = writer.dumps(self.serializer, self._groups[group_id])
+            if self.shared:
+                self._writing.add(group_id)
+                writing.append(group_id)
+                checks.append(writer.call(self._shard_path(group_id),
+                                          partial(self._write_shard_guarded, writer, group_id, payload)))
+            else:
+                writer.write(self._shard_path(group_id), payload)
+        for group_id in list(self._deleted):
+            writer.write(self._shard_path(group_id), None)
+            self._tokens.pop(group_id, None)
+            self._deleted.discard(group_id)
+
+        conflicts = []
+        if checks:
+            results = await asyncio.gather(*checks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, StateConflictError):
+                    conflicts.extend(result.keys)
+            self._writing.difference_update(writing)
+            for group_id in conflicts:
+                self._groups.pop(group_id, None)
+                self._index_pending.pop(group_id, None)
+            errors = [r for r in results if isinstance(r, Exception) and not isinstance(r, StateConflictError)]
+            if errors:
+                raise errors[0]
+
+        if self._index_pending:
+            pending, self._index_pending = self._index_pending, {}
+            if self.shared:
+                try:
+                    index, token = await writer.call(self.index_path,
+                                                     partial(self._write_index_merged, writer, pending))
+                except Exception:
+                    self._index_pending = {**pending, **self._index_pending}
+                    raise
+                # 等待期间本实例新增的修改仍保留在 _index_pending 中，下次写入
+                for gid, entry in self._index_pending.items():
+                    if entry is None:
+                        index.pop(gid, None)
+                    else:
+                        index[gid] = entry
+                self._index, self._index_token = index, token
+            else:
+                writer.write(self.index_path, writer.dumps(self.serializer, {"groups": self._index}))
+        if conflicts:
+            raise StateConflictError(conflicts)
+
+
+# --------------- 结果卡片 ---------------
+_card_fonts: Dict[Tuple[str, int], "ImageFont.ImageFont"] = {}
+# 字体缓存由渲染线程池中的多个线程共用
+_card_fonts_lock = threading.Lock()
+
+
+def _default_font(size: int):
+    """Pillow 默认字体；Pillow 10.1 起才支持指定大小，旧版本只有固定大小的位图字体"""
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def _card_font(font_path: str, size: int):
+    """加载并缓存字体；未配置或加载失败时使用 Pillow 默认字体（默认字体不含中文字形）"""
+    key = (font_path, size)
+    with _card_fonts_lock:
+        if key not in _card_fonts:
+            try:
+                _card_fonts[key] = ImageFont.truetype(font_path, size) if font_path else _default_font(size)
+            except Exception:
+                logger.error(f"加载卡片字体 {font_path} 失败，使用默认字体: {traceback.format_exc()}")
+                _card_fonts[key] = _default_font(size)
+        return _card_fonts[key]
+
+
+def _draw_centered(draw: "ImageDraw.ImageDraw", center: Tuple[int, int], text: str, font, fill) -> None:
+    """以 center 为中心绘制文字；anchor 只支持 FreeType 字体，位图字体按文字尺寸计算左上角位置"""
+    if isinstance(font, ImageFont.FreeTypeFont):
+        draw.text(center, text, font=font, fill=fill, anchor="mm")
+        return
+    if hasattr(font, "getbbox"):
+        left, top, right, bottom = font.getbbox(text)
+        width, height = right - left, bottom - top
+    else:
+        width, height = font.getsize(text)
+    draw.text((center[0] - width // 2, center[1] - height // 2), text, font=font, fill=fill)
+
+
+def _render_pair_card(avatars: Tuple[Optional[bytes], Optional[bytes]], names: Tuple[str, str],
+                      day: str, font_path: str = "") -> bytes:
+    """
+    渲染配对结果卡片（两人头像、名称、日期），返回 PNG 字节。
+    纯 CPU 计算，由线程池调用，不访问插件状态。
+    """
+    width, height, size = 480, 260, 120
+    card = PILImage.new("RGB", (width, height), (255, 240, 245))
+    draw = ImageDraw.Draw(card)
+    mask = PILImage.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, size, size), fill=255)
+    name_font = _card_font(font_path, 20)
+    for i, (avatar, name) in enumerate(zip(avatars, names)):
+        left = 50 + i * 260
+        if avatar:
+            try:
+                img = PILImage.open(io.BytesIO(avatar)).convert("RGB").resize((size, size))
+                card.paste(img, (left, 40), mask)
+            except Exception:
+                avatar = None
+        if not avatar:
+            draw.ellipse((left, 40, left + size, 40 + size), fill=(220, 220, 220))
+        _draw_centered(draw, (left + size // 2, 185), name, name_font, (80, 80, 80))
+    # 中间的爱心：两个圆加一个倒三角
+    cx, cy = width // 2, 100
+    draw.ellipse((cx - 22, cy - 16, cx, cy + 6), fill=(235, 80, 120))
+    draw.ellipse((cx, cy - 16, cx + 22, cy + 6), fill=(235, 80, 120))
+    draw.polygon([(cx - 21, cy), (cx + 21, cy), (cx, cy + 24)], fill=(235, 80, 120))
+    _draw_centered(draw, (width // 2, 232), day, _card_font(font_path, 16), (150, 150, 150))
+    buf = io.BytesIO()
+    card.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
 
 # --------------- 插件主类 ---------------
 @register("DailyWife", "jmt059", "每日老婆插件", "v1.0.4", "https://github.com/jmt059/DailyWife")
@@ -53,32 +1281,268 @@ class DailyWifePlugin(Star):
     ADVANCED_ENABLE_STATES: Dict[str, Dict[str, any]] = {}
 
     def __init__(self, context: Context, config: dict):
+        init_start = time.perf_counter()
         super().__init__(context)
         self.config = config
         self.enable_advanced_globally = self.config.get("enable_advanced_globally", False)
-        self.pair_data = self._load_pair_data()
-        self.cooling_data = self._load_cooling_data()
-        # 旧的简单 blocked_users 被替换为更复杂的手动黑名单结构
-        self.manual_blacklist = self._load_manual_blacklist()
-        self.advanced_enabled = self._load_data(ADVANCED_ENABLED_PATH, {})
         self._init_napcat_config()
-        self._migrate_old_data()
-        self._clean_invalid_cooling_records()
-        self.breakup_counts = self._load_breakup_counts()
+        self.serializer = StateSerializer(self.config.get("storage_format", "compact"))
+        # 多实例共享模式：同机多个 AstrBot 进程共用数据目录，写入时加文件锁并检查版本
+        self.shared_state = bool(self.config.get("shared_state", False))
+        if self.shared_state and fcntl is None:
+            logger.warning("⚠️ 当前系统不支持文件锁，已关闭 shared_state 多实例共享模式")
+            self.shared_state = False
+        # 全局数据文件在本实例最近一次读取/写入时的版本标识
+        self._file_tokens: Dict[Path, Optional[Tuple[int, int, int]]] = {}
+        # 数据写入在专用 I/O 线程池中执行，同一文件按提交顺序写入
+        self.writer = StateWriter(fsync=self.config.get("storage_fsync", True))
+
+        # 数据在后台任务中加载，命令处理前通过 _ensure_loaded 等待加载完成
+        self.pair_data = GroupShardStore(PAIR_DATA_DIR, self.serializer, self.shared_state)
+        # 加权抽取的历史权重：{"scores": {uid: [被抽中分数, 记录日序号]}, "partners": {uid: {伴侣: 日序号}}}
+        self.selection_weights = GroupShardStore(SELECTION_WEIGHTS_DIR, self.serializer, self.shared_state)
+        # 排行榜统计：{"counters": {指标: {uid: 值}}, "top": {指标: [[uid, 值, 名称], ...]}, "streaks": {uid: [伴侣, 日序号, 天数]}}
+        self.pair_stats = GroupShardStore(PAIR_STATS_DIR, self.serializer, self.shared_state)
+        self.cooling_data: Dict = {}
+        # 旧的简单 blocked_users 被替换为更复杂的手动黑名单结构
+        self.manual_blacklist: Dict[str, List[Dict]] = {}
+        self.advanced_enabled: Dict = {}
+        self.breakup_counts: Dict[str, Dict[str, int]] = {}
+        self._state_loaded = asyncio.Event()
+
+        # 配对历史：事件先写入内存缓冲，由后台任务批量写入数据库
+        self.history = PairHistoryStore(PAIR_HISTORY_PATH)
+        self._history_buffer: List[Tuple] = []
+        self._history_flush_task: Optional[asyncio.Task] = None
+        self._history_lock = asyncio.Lock()
+        self._history_pruned_day: Optional[str] = None
+
+        # 群成员列表缓存 {group_id: (获取时间, MemberList)} 与每个群的候选池
+        self._member_cache: Dict[str, Tuple[float, MemberList]] = {}
+        self._eligible_pools: Dict[str, EligiblePool] = {}
+
+        # 结果卡片：渲染在独立线程池中进行，按 (群号, 配对双方, 日期) 缓存 PNG 字节
+        self._card_executor: Optional[ThreadPoolExecutor] = None
+        self._card_cache: Dict[Tuple[str, str, str, str], bytes] = {}
+        # 查询老婆的回复缓存 {(group_id, user_id): (日期, 文本, 图片字节, 是否有伴侣)}，按最近使用排序（LRU），
+        # 另按群索引已缓存的用户，配对数据保存时按群失效
+        self._reply_cache: "OrderedDict[Tuple[str, str], Tuple[str, str, Optional[bytes], bool]]" = OrderedDict()
+        self._reply_users: Dict[str, set] = {}
+        # 准入控制：正则触发命令的用户/群令牌桶限流、同一用户重复请求合并，以及出站请求的全局并发上限
+        self._user_limiter = RateLimiter(self.config.get("user_rate_per_minute", 6), self.config.get("user_burst", 3))
+        self._group_limiter = RateLimiter(self.config.get("group_rate_per_minute", 60),
+                                          self.config.get("group_burst", 20))
+        self._limit_notified: set = set()
+        self._inflight: set = set()
+        self._member_fetches: Dict[str, asyncio.Future] = {}
+        self._outbound_limits = {
+            "napcat": asyncio.Semaphore(max(self.config.get("napcat_concurrency", 4), 1)),
+            "avatar": asyncio.Semaphore(max(self.config.get("avatar_concurrency", 8), 1)),
+        }
+        # 运行指标，由 /老婆插件状态 查看
+        self.metrics: Dict[str, float] = {}
 
         # 存储进阶功能每日使用计数：{group_id: {user_id: {"wish": int, "rob": int, "lock": int}}}
         self.advanced_usage: Dict[str, Dict[str, Dict[str, int]]] = {}
-
-        # 启动定时任务检查进阶功能开启是否超时
-        asyncio.create_task(self._check_advanced_enable_timeout())
+        self._advanced_usage_day = datetime.now().strftime("%Y-%m-%d")
+        # 工作集：只在内存中保留最近活跃的群，其余群的分片、候选池和缓存换出，下次访问时重新加载
+        self.working_set = GroupWorkingSet(self.config.get("working_set_max_groups", 200),
+                                           self.config.get("working_set_idle_minutes", 30) * 60)
+        # 数据清理：同一时间只运行一次，最近一次的结果由 /老婆插件状态 显示
+        self._compact_lock = asyncio.Lock()
+        self._last_compaction: Optional[Tuple[str, Dict[str, int]]] = None
+
+        # 后台任务：加载数据 / 检查进阶功能开启是否超时 / 每日数据清理 / 换出空闲的群
+        self._background_tasks: List[asyncio.Task] = [
+            asyncio.create_task(self._load_state()),
+            asyncio.create_task(self._check_advanced_enable_timeout()),
+            asyncio.create_task(self._compact_task()),
+            asyncio.create_task(self._working_set_task()),
+        ]
+        if self.shared_state:
+            self._background_tasks.append(asyncio.create_task(self._watch_shared_state()))
 
         # 确保默认全球屏蔽 q群管家（不会写入每个用户的黑名单文件，而是在筛选时作为永远排除）
         logger.info(f"✅ 已启用全局永久排除 QQ：{GLOBAL_EXCLUDE_QQ}")
+        logger.info(f"⏱️ 插件初始化完成，耗时 {(time.perf_counter() - init_start) * 1000:.1f}ms（数据后台加载中）")
+
+    # --------------- 启动加载 ---------------
+    async def _load_state(self):
+        """在线程中读取并解析所有数据文件，完成后在事件循环中执行迁移和清理。"""
+        load_start = time.perf_counter()
+        try:
+            (self.cooling_data, self.manual_blacklist,
+             self.advanced_enabled, self.breakup_counts, meta) = await asyncio.to_thread(self._read_state_files)
+            if meta.get("schema_version", 0) < SCHEMA_VERSION:
+                await self._migrate_old_data(meta.get("schema_version", 0))
+                self._save_data(STATE_META_PATH, {"schema_version": SCHEMA_VERSION})
+            self._migrate_config_block_list()
+            self._clean_invalid_cooling_records()
+        except Exception:
+            logger.error(f"数据加载失败: {traceback.format_exc()}")
+        finally:
+            self._state_loaded.set()
+        logger.info(f"⏱️ 数据加载完成，耗时 {(time.perf_counter() - load_start) * 1000:.1f}ms，"
+                    f"共 {len(self.pair_data)} 个群")
+
+    def _read_state_files(self) -> Tuple[Dict, Dict, Dict, Dict, Dict]:
+        for path in self._shared_files():
+            self._file_tokens[path] = _file_token(path)
+        self._load_pair_data()
+        self.selection_weights.load()
+        self.pair_stats.load()
+        try:
+            self.history.open()
+        except Exception:
+            logger.error(f"配对历史数据库打开失败: {traceback.format_exc()}")
+        return (
+            self._load_cooling_data(),
+            self._load_manual_blacklist(),
+            self._load_data(ADVANCED_ENABLED_PATH, {}),
+            self._load_breakup_counts(),
+            self._load_data(STATE_META_PATH, {}) or {},
+        )
+
+    async def _ensure_loaded(self, event: Optional[AstrMessageEvent] = None):
+        if not self._state_loaded.is_set():
+            await self._state_loaded.wait()
+        if self.shared_state:
+            await self._sync_shared_state()
+        if event is not None and event.message_obj.group_id:
+            self._touch_group(str(event.message_obj.group_id))
+
+    async def _pinned(self, event: AstrMessageEvent, handler):
+        """
+        处理期间固定消息所在群的配对数据：共享数据同步和工作集换出都不会丢弃该群的内存副本，
+        处理中等待成员列表、头像等请求时持有的数据在保存时仍是常驻的那一份（被其他实例修改时按冲突处理）。
+        """
+        await self._ensure_loaded(event)
+        group_id = str(getattr(event.message_obj, "group_id", "") or "")
+        self.pair_data.pin(group_id)
+        try:
+            async for result in handler:
+                yield result
+        finally:
+            self.pair_data.unpin(group_id)
+
+    # --------------- 工作集 ---------------
+    def _touch_group(self, group_id: str):
+        """记录群的访问；工作集超出群数量上限时立即换出最久未访问的群"""
+        self.working_set.touch(group_id)
+        if self.working_set.over_budget():
+            self._evict_groups()
+
+    def _resident_groups(self) -> set:
+        """当前在内存中持有数据的群"""
+        return (set(self.pair_data.loaded_keys()) | set(self.selection_weights.loaded_keys())
+                | set(self.pair_stats.loaded_keys()) | set(self._eligible_pools) | set(self._member_cache)
+                | set(self._reply_users))
+
+    def _evict_groups(self) -> int:
+        """换出工作集选出的群，仍有命令在处理中、有未保存修改或写入未完成的群留到下次。返回换出的群数量"""
+        stores = (self.pair_data, self.selection_weights, self.pair_stats)
+        evicted = 0
+        for group_id in self.working_set.victims(
+                time.monotonic(), lambda gid: all(store.evictable(gid, self.writer) for store in stores)):
+            for store in stores:
+                store.evict(group_id)
+            self._eligible_pools.pop(group_id, None)
+            self._member_cache.pop(group_id, None)
+            self._invalidate_replies(group_id)
+            for key in [k for k in self._card_cache if k[0] == group_id]:
+                del self._card_cache[key]
+            self.working_set.discard(group_id)
+            evicted += 1
+        if evicted:
+            self._metric_add("working_set_evictions", evicted)
+        return evicted
+
+    def _sweep_working_set(self) -> int:
+        """换出空闲的群；由导出、清理、重置其他群等非本群命令加载的群从现在开始计算空闲时间"""
+        now = time.monotonic()
+        for group_id in self._resident_groups():
+            if group_id not in self.working_set:
+                self.working_set.touch(group_id, now)
+        return self._evict_groups()
+
+    async def _working_set_task(self):
+        """定期换出空闲的群"""
+        await self._state_loaded.wait()
+        while True:
+            await asyncio.sleep(WORKING_SET_SWEEP_SECONDS)
+            try:
+                evicted = self._sweep_working_set()
+                if evicted:
+                    logger.debug(f"已将 {evicted} 个空闲群的数据换出内存，常驻 {len(self.working_set)} 个群")
+            except Exception:
+                logger.error(f"换出空闲群数据失败: {traceback.format_exc()}")
+
+    # --------------- 多实例共享 ---------------
+    def _shared_files(self) -> Dict[Path, Tuple[Callable[[], Dict], str]]:
+        """各全局数据文件的加载函数与对应属性名，文件被其他实例修改后据此重新加载"""
+        return {
+            COOLING_DATA_PATH: (self._load_cooling_data, "cooling_data"),
+            USER_MANUAL_BLOCKED_PATH: (self._load_manual_blacklist, "manual_blacklist"),
+            ADVANCED_ENABLED_PATH: (lambda: self._load_data(ADVANCED_ENABLED_PATH, {}), "advanced_enabled"),
+            BREAKUP_COUNT_PATH: (self._load_breakup_counts, "breakup_counts"),
+        }
+
+    async def _sync_shared_state(self) -> List[str]:
+        """
+        检查其他实例的修改：重新加载发生变化的全局数据文件，丢弃已过期的群分片和候选池。
+        每次处理命令前调用，开销为每个已加载文件一次 stat。返回发生变化的数据名称。
+        """
+        changed = []
+        for path, (loader, attr) in self._shared_files().items():
+            # 本实例仍有写入在排队时，文件版本以写入完成后的为准
+            if self.writer.pending(path):
+                continue
+            token = _file_token(path)
+            if token != self._file_tokens.get(path):
+                self._file_tokens[path] = token
+                setattr(self, attr, await asyncio.to_thread(loader))
+                changed.append(path.name)
+        try:
+            for group_id in self.pair_data.refresh():
+                self._eligible_pools.pop(group_id, None)
+                self._invalidate_replies(group_id)
+                changed.append(f"群 {group_id}")
+            self.selection_weights.refresh()
+            self.pair_stats.refresh()
+        except Exception:
+            logger.error(f"同步共享数据失败: {traceback.format_exc()}")
+        return changed
+
+    async def _watch_shared_state(self):
+        """定期检查其他实例的修改，空闲时也能及时丢弃过期数据，间隔由 shared_state_poll_seconds 配置"""
+        await self._state_loaded.wait()
+        interval = max(self.config.get("shared_state_poll_seconds", 2), 0.5)
+        while True:
+            await asyncio.sleep(interval)
+            changed = await self._sync_shared_state()
+            if changed:
+                logger.debug(f"检测到其他实例修改了数据: {', '.join(changed)}")
+
+    def _write_guarded(self, path: Path, payload: bytes) -> None:
+        """
+        在 I/O 线程中执行：文件锁内确认文件自本实例读取后未被修改再写入。
+        冲突时不更新版本标识，下次同步时会重新加载其他实例写入的版本。
+        """
+        with FileLock(path):
+            if _file_token(path) != self._file_tokens.get(path):
+                raise StateConflictError([path.name])
+            self.writer.write_file(path, payload)
+            self._file_tokens[path] = _file_token(path)
+
+    @staticmethod
+    def _log_write_conflict(future: asyncio.Future):
+        if not future.cancelled() and isinstance(future.exception(), StateConflictError):
+            logger.warning(f"数据写入冲突，已放弃本次修改，将重新加载其他实例的版本: {future.exception()}")
 
     # --------------- 数据迁移 ---------------
-    def _migrate_old_data(self):
+    def _migrate_config_block_list(self):
+        """兼容旧配置中单一屏蔽列表（block_list），该项来自配置而非数据文件，每次启动都需检查。"""
         try:
-            # 兼容旧配置中单一屏蔽列表（block_list）
             if "block_list" in self.config:
                 old_list = set(map(str, self.config["block_list"]))
                 # 将旧数据迁移到 manual_blacklist：对所有用户生效（采用全局单向? 这里转成全局双向由默认行为决定）
@@ -89,25 +1553,39 @@ class DailyWifePlugin(Star):
                 # 仍保留兼容（移除旧项）
                 del self.config["block_list"]
                 self._save_manual_blacklist()
+        except Exception:
+            logger.error(f"旧屏蔽列表迁移失败: {traceback.format_exc()}")
+
+    async def _migrate_old_data(self, version: int = 0):
+        """
+        按数据结构版本迁移配对数据：
+        v1 之前配对值为纯QQ号字符串；v2 之前伴侣名称以 "名称(QQ号)" 字符串保存。
+        """
+        try:
+            changed = False
             for group_id in list(self.pair_data.keys()):
                 pairs = self.pair_data[group_id].get("pairs", {})
-                for uid in list(pairs.keys()):
-                    if "is_initiator" not in pairs[uid]:
-                        pairs[uid]["is_initiator"] = True
-                if isinstance(pairs, dict) and all(isinstance(v, str) for v in pairs.values()):
+                if isinstance(pairs, dict) and pairs and all(isinstance(v, str) for v in pairs.values()):
                     new_pairs = {}
                     for user_id, target_id in pairs.items():
-                        new_pairs[user_id] = {
-                            "user_id": target_id,
-                            "display_name": f"未知用户({target_id})"
-                        }
+                        new_pairs[user_id] = _partner_record(target_id, "未知用户")
                         if target_id in pairs:
-                            new_pairs[target_id] = {
-                                "user_id": user_id,
-                                "display_name": f"未知用户({user_id})"
-                            }
-                    self.pair_data[group_id]["pairs"] = new_pairs
-                    self._save_pair_data()
+                            new_pairs[target_id] = _partner_record(user_id, "未知用户")
+                    self.pair_data[group_id]["pairs"] = pairs = new_pairs
+                    self.pair_data.mark_dirty(group_id)
+                    changed = True
+                for uid in list(pairs.keys()):
+                    if "is_initiator" not in pairs[uid]:
+                        pairs[uid]["is_initiator"] = True
+                        self.pair_data.mark_dirty(group_id)
+                        changed = True
+                if version < 2:
+                    upgraded = [_upgrade_partner_record(record) for record in pairs.values()]
+                    if any(upgraded):
+                        self.pair_data.mark_dirty(group_id)
+                        changed = True
+            if changed:
+                await self._save_pair_data()
         except Exception:
             logger.error(f"数据迁移失败: {traceback.format_exc()}")
 
@@ -126,6 +1604,21 @@ class DailyWifePlugin(Star):
                 if not parsed.hostname or not parsed.port:
                     raise ValueError(f"无效的Napcat地址格式: {host}")
 
+            # 可选的 WebSocket 传输：napcat_ws_hosts 与 napcat_host 按顺序一一对应，连接不可用时退回 HTTP
+            self._ws_clients: Dict[str, OneBotWebSocket] = {}
+            if self.config.get("napcat_transport", "http") == "websocket":
+                ws_hosts = [h.strip() for h in (self.config.get("napcat_ws_hosts") or "").split(",") if h.strip()]
+                if len(ws_hosts) != len(self.napcat_hosts):
+                    logger.error(
+                        f"napcat_ws_hosts 的地址数量（{len(ws_hosts)}）与 napcat_host（{len(self.napcat_hosts)}）不一致，"
+                        f"已改用 HTTP 传输"
+                    )
+                else:
+                    for host, ws_host in zip(self.napcat_hosts, ws_hosts):
+                        url = ws_host if "://" in ws_host else f"ws://{ws_host}/"
+                        self._ws_clients[host] = OneBotWebSocket(url, self.config.get("napcat_token", ""))
+                    logger.info(f"✅ NapCat 使用 WebSocket 传输: {[c.url for c in self._ws_clients.values()]}")
+
             logger.info(f"✅ 已加载 {len(self.napcat_hosts)} 个Napcat主机: {self.napcat_hosts}")
 
         except Exception as e:
@@ -142,23 +1635,18 @@ class DailyWifePlugin(Star):
         return host
 
     # --------------- 数据管理 ---------------
-    def _load_pair_data(self) -> Dict:
+    def _load_pair_data(self):
         try:
-            if PAIR_DATA_PATH.exists():
-                with open(PAIR_DATA_PATH, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            return {}
+            self.pair_data.load(legacy_path=PAIR_DATA_PATH)
         except Exception:
             logger.error(f"配对数据加载失败: {traceback.format_exc()}")
-            return {}
 
     def _load_cooling_data(self) -> Dict:
         try:
             if COOLING_DATA_PATH.exists():
-                with open(COOLING_DATA_PATH, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    return {k: {"users": v["users"], "expire_time": datetime.fromisoformat(v["expire_time"])}
-                            for k, v in data.items()}
+                data = _read_state_file(COOLING_DATA_PATH)
+                return {k: {"users": v["users"], "expire_time": datetime.fromisoformat(v["expire_time"])}
+                        for k, v in data.items()}
             return {}
         except Exception:
             logger.error(f"冷静期数据加载失败: {traceback.format_exc()}")
@@ -177,19 +1665,18 @@ class DailyWifePlugin(Star):
         """
         try:
             if USER_MANUAL_BLOCKED_PATH.exists():
-                with open(USER_MANUAL_BLOCKED_PATH, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    # 兼容化：确保所有 key/values 为字符串或正确类型
-                    cleaned = {}
-                    for k, v in data.items():
-                        cleaned[k] = []
-                        for entry in v:
-                            cleaned[k].append({
-                                "blocked_user": str(entry.get("blocked_user")),
-                                "scope": entry.get("scope", "all"),
-                                "two_way": bool(entry.get("two_way", True))
-                            })
-                    return cleaned
+                data = _read_state_file(USER_MANUAL_BLOCKED_PATH)
+                # 兼容化：确保所有 key/values 为字符串或正确类型
+                cleaned = {}
+                for k, v in data.items():
+                    cleaned[k] = []
+                    for entry in v:
+                        cleaned[k].append({
+                            "blocked_user": str(entry.get("blocked_user")),
+                            "scope": entry.get("scope", "all"),
+                            "two_way": bool(entry.get("two_way", True))
+                        })
+                return cleaned
             return {}
         except Exception:
             logger.error(f"手动黑名单加载失败: {traceback.format_exc()}")
@@ -197,86 +1684,111 @@ class DailyWifePlugin(Star):
 
     def _load_data(self, path: Path, default=None):
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return _read_state_file(path)
         except FileNotFoundError:
             return default
-        except json.JSONDecodeError:
-            logger.error(f"JSON 文件 {path} 解码错误，已返回默认值。")
+        except ValueError:
+            logger.error(f"数据文件 {path} 解码错误，已返回默认值。")
             return default
         except Exception:
             logger.error(f"加载数据文件 {path} 失败: {traceback.format_exc()}")
             return default
 
-    def _save_pair_data(self):
+    async def _save_pair_data(self, group_id: Optional[str] = None):
+        """
+        保存配对数据；传入 group_id 时标记该群已修改，只有被修改的群分片会写入磁盘。
+        写入在 I/O 线程中进行；共享模式下会等待写入完成，冲突时抛出 StateConflictError。
+        """
+        # 所有配对变化（抽取/分手/许愿/强娶/锁定/重置/跨日）都经过这里保存，同时让回复缓存失效
+        self._invalidate_replies(group_id)
         try:
-            if not PAIR_DATA_PATH.parent.exists():
-                PAIR_DATA_PATH.parent.mkdir(parents=True, exist_ok=True)
-            temp_path = PAIR_DATA_PATH.with_suffix(".tmp")
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(self.pair_data, f, ensure_ascii=False, indent=2)
-            temp_path.replace(PAIR_DATA_PATH)
+            if group_id is not None:
+                self.pair_data.mark_dirty(group_id)
+            await self.pair_data.flush_async(self.writer)
+        except StateConflictError as e:
+            # 冲突的群已从内存中丢弃，下次访问时读取其他实例写入的版本
+            for gid in e.keys:
+                self._eligible_pools.pop(gid, None)
+                self._invalidate_replies(gid)
+            logger.warning(f"配对数据写入冲突，已放弃本次修改: {e}")
+            raise
         except Exception:
             logger.error(f"保存配对数据失败: {traceback.format_exc()}")
             raise
 
+    def _cooling_data_snapshot(self) -> Dict:
+        return {k: {"users": v["users"], "expire_time": v["expire_time"].isoformat()}
+                for k, v in self.cooling_data.items()}
+
     def _save_cooling_data(self):
-        temp_data = {k: {"users": v["users"], "expire_time": v["expire_time"].isoformat()}
-                     for k, v in self.cooling_data.items()}
-        self._save_data(COOLING_DATA_PATH, temp_data)
+        self._save_data(COOLING_DATA_PATH, self._cooling_data_snapshot())
 
     def _save_manual_blacklist(self):
         try:
-            temp_path = USER_MANUAL_BLOCKED_PATH.with_suffix(".tmp")
-            temp_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(temp_path, "w", encoding="utf-8") as f:
-                json.dump(self.manual_blacklist, f, ensure_ascii=False, indent=2)
-            temp_path.replace(USER_MANUAL_BLOCKED_PATH)
+            self._write_state(USER_MANUAL_BLOCKED_PATH, self.manual_blacklist)
         except Exception:
             logger.error(f"保存手动黑名单失败: {traceback.format_exc()}")
 
     def _save_data(self, path: Path, data: dict):
         try:
-            temp_path = path.with_suffix(".tmp")
-            temp_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(temp_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            temp_path.replace(path)
+            self._write_state(path, data)
         except Exception:
             logger.error(f"数据保存失败: {traceback.format_exc()}")
 
+    def _write_state(self, path: Path, data: dict, log_conflict: bool = True) -> asyncio.Future:
+        """在事件循环中序列化快照后提交给 I/O 线程写入，返回写入完成时结束的 future"""
+        payload = self.writer.dumps(self.serializer, data)
+        if self.shared_state and path in self._file_tokens:
+            future = self.writer.call(path, partial(self._write_guarded, path, payload))
+            if log_conflict:
+                future.add_done_callback(self._log_write_conflict)
+            return future
+        return self.writer.write(path, payload)
+
+    async def _update_global(self, path: Path, apply: Callable[[], Any]):
+        """
+        修改一个全局数据文件（apply 在内存中执行修改）并等待写入完成，返回最后一次 apply 的结果。
+        共享模式下若文件已被其他实例修改，重新加载后再执行一次 apply 并重试，仍然冲突时抛出 StateConflictError。
+        apply 每次都应通过 self 访问数据，重新加载后属性指向新的对象。
+        """
+        loader, attr = self._shared_files()[path]
+        for attempt in range(2):
+            result = apply()
+            data = self._cooling_data_snapshot() if path == COOLING_DATA_PATH else getattr(self, attr)
+            try:
+                await self._write_state(path, data, log_conflict=False)
+                return result
+            except StateConflictError:
+                if attempt:
+                    raise
+                # 等本实例排在后面的写入（同样会冲突）结束后再加载其他实例的版本，避免旧内容借新版本标识写入
+                await self.writer.call(path, lambda: None)
+                token = _file_token(path)
+                setattr(self, attr, await asyncio.to_thread(loader))
+                self._file_tokens[path] = token
+            except Exception:
+                logger.error(f"数据保存失败: {traceback.format_exc()}")
+                return result
+
     def _load_breakup_counts(self) -> Dict[str, Dict[str, int]]:
         try:
             if BREAKUP_COUNT_PATH.exists():
-                with open(BREAKUP_COUNT_PATH, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    return {date: {k: int(v) for k, v in counts.items()} for date, counts in data.items()}
+                data = _read_state_file(BREAKUP_COUNT_PATH)
+                return {date: {k: int(v) for k, v in counts.items()} for date, counts in data.items()}
             return {}
         except Exception:
             logger.error(f"分手次数数据加载失败: {traceback.format_exc()}")
             return {}
 
-    def _parse_display_info(self, raw_info: str) -> Tuple[str, str]:
-        try:
-            if '(' in raw_info and raw_info.endswith(')'):
-                name_part, qq_part = raw_info.rsplit('(', 1)
-                return name_part.strip(), qq_part[:-1]
-            if '(' not in raw_info:
-                return raw_info, "未知QQ号"
-            parts = raw_info.split('(')
-            if len(parts) >= 2:
-                return parts[0].strip(), parts[-1].replace(')', '')
-            return raw_info, "解析失败"
-        except Exception as e:
-            logger.error(f"解析display_info失败：{raw_info} | 错误：{str(e)}")
-            return raw_info, "解析异常"
-
     def _format_display_info(self, raw_info: str) -> str:
-        nickname, qq = self._parse_display_info(raw_info)
-        max_len = self.config.get("display_name_max_length", 10)
-        safe_nickname = nickname.replace("\n", "").replace("\r", "").strip()
-        formatted_nickname = safe_nickname[:max_len] + "……" if len(safe_nickname) > max_len else safe_nickname
-        return f"{formatted_nickname}({qq})"
+        """格式化配对历史/排行榜中保存的 名称(QQ号) 字符串"""
+        nickname, qq = _split_display_info(raw_info)
+        return f"{_format_name(nickname, self.config.get('display_name_max_length', 10))}({qq or '未知QQ号'})"
+
+    def _partner_label(self, record: dict) -> str:
+        """伴侣记录的回复显示文本 名称(QQ号)，名称按 display_name_max_length 截断"""
+        name = _format_name(_partner_name(record), self.config.get("display_name_max_length", 10))
+        return f"{name}({record['user_id']})"
 
     # --------------- 手动黑名单操作 ---------------
     def _add_manual_block(self, owner_id: str, blocked_qq: str, scope: str = "all", two_way: bool = True,
@@ -297,6 +1809,60 @@ class DailyWifePlugin(Star):
         if save:
             self._save_manual_blacklist()
 
+    @staticmethod
+    def _parse_blacklist_row(tokens: List[str]) -> Tuple[Optional[Tuple[str, str, bool]], Optional[str]]:
+        """
+        解析 [QQ号] [all/群号] [双向/单向]，范围默认 all，默认双向。
+        返回 ((QQ号, scope, two_way), None)，参数有误时返回 (None, 错误说明)。
+        """
+        if not tokens or not tokens[0].isdigit():
+            return None, "QQ号应为数字"
+        scope = "all"
+        two_way = True
+        if len(tokens) >= 2:
+            scope = tokens[1].strip()
+            if scope != "all" and not scope.isdigit():
+                return None, "第2个参数应为 all 或 群号（数字）"
+        if len(tokens) >= 3:
+            tw = tokens[2].strip()
+            if tw in ("双向", "true", "True", "1"):
+                two_way = True
+            elif tw in ("单向", "false", "False", "0"):
+                two_way = False
+            else:
+                return None, "第3个参数应为 双向 或 单向"
+        return (tokens[0], scope, two_way), None
+
+    def _add_manual_blocks(self, entries: List[Tuple[str, str, str, bool]]) -> Tuple[int, int, int]:
+        """
+        批量添加黑名单条目 (owner, QQ号, scope, two_way)，按 (owner, QQ号, scope) 去重，只修改内存，由调用方一次性保存。
+        返回 (新增数, 更新数, 未变化数)。
+        """
+        added = updated = unchanged = 0
+        indexes: Dict[str, Dict[Tuple[str, str], Dict]] = {}
+        for owner_id, blocked_qq, scope, two_way in entries:
+            owner_id, blocked_qq = str(owner_id), str(blocked_qq)
+            if owner_id not in indexes:
+                indexes[owner_id] = {(e["blocked_user"], e["scope"]): e
+                                     for e in self.manual_blacklist.get(owner_id, [])}
+            index = indexes[owner_id]
+            existing = index.get((blocked_qq, scope))
+            if existing is None:
+                entry = {"blocked_user": blocked_qq, "scope": scope, "two_way": bool(two_way)}
+                self.manual_blacklist.setdefault(owner_id, []).append(entry)
+                index[(blocked_qq, scope)] = entry
+                added += 1
+            elif existing["two_way"] != bool(two_way):
+                existing["two_way"] = bool(two_way)
+                updated += 1
+            else:
+                unchanged += 1
+        return added, updated, unchanged
+
+    @staticmethod
+    def _format_blacklist_row(entry: Dict) -> str:
+        return f"{entry['blocked_user']} {entry['scope']} {'双向' if entry['two_way'] else '单向'}"
+
     def _remove_manual_block(self, owner_id: str, blocked_qq: str, scope: Optional[str] = None,
                              save: bool = True) -> bool:
         owner_id = str(owner_id)
@@ -360,6 +1926,7 @@ class DailyWifePlugin(Star):
     @filter.command("重置")
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def reset_command_handler(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         parts = event.message_str.split()
         args = parts[1:] if len(parts) > 1 else []
         if not args:
@@ -378,13 +1945,18 @@ class DailyWifePlugin(Star):
             return
         arg = args[0]
         if arg == "-a":
-            self.pair_data = {}
+            self.pair_data.clear()
+            self.selection_weights.clear()
+            await self.selection_weights.flush_async(self.writer)
+            self.pair_stats.clear()
+            await self.pair_stats.flush_async(self.writer)
+            self._eligible_pools.clear()
             self.cooling_data = {}
             self.manual_blacklist = {}
             self.breakup_counts = {}
             self.advanced_usage = {}
             self.advanced_enabled = {}
-            self._save_pair_data()
+            await self._save_pair_data()
             self._save_cooling_data()
             self._save_manual_blacklist()
             self._save_data(BREAKUP_COUNT_PATH, self.breakup_counts)
@@ -399,46 +1971,211 @@ class DailyWifePlugin(Star):
             group_id = str(arg)
             if group_id in self.pair_data:
                 del self.pair_data[group_id]
-                self._save_pair_data()
+                self._eligible_pools.pop(group_id, None)
+                await self._save_pair_data()
                 yield event.plain_result(f"✅ 已重置群组 {group_id} 的配对数据")
             else:
                 yield event.plain_result(f"⚠ 未找到群组 {group_id} 的记录")
         else:
             option_map = {
-                "-p": ("配对数据", lambda: self._reset_pairs()),
-                "-c": ("冷静期数据", lambda: self._reset_cooling()),
-                "-b": ("手动黑名单", lambda: self._reset_manual_blacklist()),
-                "-d": ("分手记录", lambda: self._reset_breakups())
+                "-p": ("配对数据", self._reset_pairs),
+                "-c": ("冷静期数据", self._reset_cooling),
+                "-b": ("手动黑名单", self._reset_manual_blacklist),
+                "-d": ("分手记录", self._reset_breakups)
             }
             if arg not in option_map:
                 yield event.plain_result("❌ 无效选项\n使用帮助查看可用选项")
                 return
             opt_name, reset_func = option_map[arg]
-            reset_func()
+            await reset_func()
             yield event.plain_result(f"✅ 已重置 {opt_name}")
 
-    def _reset_pairs(self):
-        self.pair_data = {}
-        self._save_pair_data()
+    async def _reset_pairs(self):
+        self.pair_data.clear()
+        self._eligible_pools.clear()
+        await self._save_pair_data()
 
-    def _reset_cooling(self):
+    async def _reset_cooling(self):
         self.cooling_data = {}
         self._save_cooling_data()
 
-    def _reset_manual_blacklist(self):
+    async def _reset_manual_blacklist(self):
         self.manual_blacklist = {}
         self._save_manual_blacklist()
 
-    def _reset_breakups(self):
+    async def _reset_breakups(self):
         self.breakup_counts = {}
         self._save_data(BREAKUP_COUNT_PATH, self.breakup_counts)
 
-    def _save_all_data(self):
-        self._save_pair_data()
+    async def _save_all_data(self):
+        await self._save_pair_data()
         self._save_cooling_data()
         self._save_manual_blacklist()
         self._save_data(BREAKUP_COUNT_PATH, self.breakup_counts)
 
+    @filter.command("老婆插件状态")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def status_command(self, event: AstrMessageEvent):
+        """查看插件运行指标"""
+        await self._ensure_loaded(event)
+        m = self.metrics
+        renders = m.get("card_renders", 0)
+        lines = [
+            "📊 老婆插件运行状态",
+            f"▸ 查询回复缓存：命中 {m.get('reply_cache_hits', 0):.0f} 次，未命中 {m.get('reply_cache_misses', 0):.0f} 次，"
+            f"缓存 {len(self._reply_cache)} 条",
+            f"▸ 结果卡片：渲染 {renders:.0f} 次，缓存命中 {m.get('card_cache_hits', 0):.0f} 次，"
+            f"失败 {m.get('card_render_failures', 0):.0f} 次，缓存 {len(self._card_cache)} 张",
+        ]
+        names = _format_name.cache_info()
+        lines.append(f"▸ 名称格式化缓存：命中 {names.hits} 次，未命中 {names.misses} 次，缓存 {names.currsize} 条")
+        if renders:
+            lines.append(f"▸ 卡片渲染耗时：平均 {m['card_render_ms_total'] / renders:.1f}ms，"
+                         f"最长 {m['card_render_ms_max']:.1f}ms")
+        lines.append(f"▸ 限流：用户 {m.get('rate_limited_user', 0):.0f} 次，群 {m.get('rate_limited_group', 0):.0f} 次"
+                     f"（其中缓存回复 {m.get('rate_limited_cached_replies', 0):.0f} 次），"
+                     f"合并重复请求 {m.get('requests_collapsed', 0):.0f} 次，合并成员列表请求 "
+                     f"{m.get('member_fetch_collapsed', 0):.0f} 次")
+        lines.append(f"▸ 出站请求：NapCat {m.get('napcat_calls', 0):.0f} 次（排队 {m.get('napcat_waits', 0):.0f} 次），"
+                     f"头像 {m.get('avatar_calls', 0):.0f} 次（排队 {m.get('avatar_waits', 0):.0f} 次）")
+        if self._last_compaction is not None:
+            when, report = self._last_compaction
+            lines.append(f"▸ 最近清理（{when}）：{report['groups']} 个群，{report['records']} 条记录，"
+                         f"{report['cache']} 条缓存，回收 {report['bytes'] / 1024:.1f}KB")
+        lines.append(f"▸ NapCat 调用来源：当前连接 {m.get('napcat_via_event', 0):.0f} 次（失败 "
+                     f"{m.get('napcat_event_client_failures', 0):.0f} 次），WebSocket {m.get('napcat_via_ws', 0):.0f} 次，"
+                     f"HTTP {m.get('napcat_via_http', 0):.0f} 次")
+        for host, client in self._ws_clients.items():
+            lines.append(f"▸ WebSocket {host}：{'已连接' if client.connected else '未连接'}，调用 {client.stats['calls']} 次，"
+                         f"超时 {client.stats['timeouts']} 次，连接 {client.stats['connects']} 次")
+        if self._ws_clients:
+            lines.append(f"▸ WebSocket 失败改用 HTTP：{m.get('napcat_ws_fallbacks', 0):.0f} 次")
+        io_stats = self.writer.stats
+        writes = io_stats.get("writes", 0)
+        lines.append(f"▸ 数据写入：{writes:.0f} 次（{io_stats.get('write_bytes', 0) / 1024:.1f}KB），"
+                     f"合并 {io_stats.get('coalesced', 0):.0f} 次，失败 {io_stats.get('failures', 0):.0f} 次")
+        if writes:
+            lines.append(f"▸ 写入耗时（累计）：序列化 {io_stats.get('serialize_ms', 0):.1f}ms，"
+                         f"写入 {io_stats.get('write_ms', 0):.1f}ms，fsync {io_stats.get('fsync_ms', 0):.1f}ms")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("清理老婆数据")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def compact_command(self, event: AstrMessageEvent):
+        """立即执行一次数据清理（平时每天自动执行）"""
+        await self._ensure_loaded(event)
+        try:
+            report = await self._compact_state()
+        except Exception:
+            logger.error(f"数据清理失败: {traceback.format_exc()}")
+            yield event.plain_result("❌ 数据清理失败，请查看日志")
+            return
+        yield event.plain_result(
+            f"🧹 数据清理完成：删除 {report['groups']} 个超过 {self.config.get('state_retention_days', 7)} 天未活动的群，"
+            f"{report['records']} 条过期记录，{report['cache']} 条过期缓存，回收 {report['bytes'] / 1024:.1f}KB")
+
+    @filter.command("老婆内存占用")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def memory_command(self, event: AstrMessageEvent):
+        """查看各数据结构的内存占用估算与工作集状态"""
+        await self._ensure_loaded(event)
+
+        def shards(store: GroupShardStore) -> Tuple[int, int]:
+            loaded = store.loaded_keys()
+            return len(loaded), sum(_deep_sizeof(store[gid]) for gid in loaded)
+
+        rows = [
+            ("配对数据", *shards(self.pair_data), "个群"),
+            ("加权抽取数据", *shards(self.selection_weights), "个群"),
+            ("排行榜统计", *shards(self.pair_stats), "个群"),
+            ("候选池", len(self._eligible_pools), _deep_sizeof(self._eligible_pools), "个群"),
+            ("成员列表缓存", len(self._member_cache), _deep_sizeof(self._member_cache), "个群"),
+            ("查询回复缓存", len(self._reply_cache), _deep_sizeof((self._reply_cache, self._reply_users)), "条"),
+            ("结果卡片缓存", len(self._card_cache), _deep_sizeof(self._card_cache), "张"),
+            ("冷静期数据", len(self.cooling_data), _deep_sizeof(self.cooling_data), "条"),
+            ("手动黑名单", len(self.manual_blacklist), _deep_sizeof(self.manual_blacklist), "人"),
+            ("分手计数", len(self.breakup_counts), _deep_sizeof(self.breakup_counts), "天"),
+            ("进阶功能使用计数", len(self.advanced_usage), _deep_sizeof(self.advanced_usage), "个群"),
+        ]
+        ws = self.working_set
+        lines = [
+            "📦 老婆插件内存占用（估算）",
+            f"▸ 工作集：常驻 {len(ws)} 个群（上限 {ws.max_groups or '不限'}，"
+            f"空闲 {ws.idle_seconds / 60:.0f} 分钟后换出），共 {len(self.pair_data)} 个群",
+            f"▸ 累计换出 {self.metrics.get('working_set_evictions', 0):.0f} 个群，"
+            f"从磁盘加载配对数据 {self.pair_data.loads} 次",
+        ]
+        lines.extend(f"▸ {name}：{count} {unit}，{size / 1024:.1f}KB" for name, count, size, unit in rows)
+        lines.append(f"▸ 合计：{sum(row[2] for row in rows) / 1024:.1f}KB")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("导出老婆数据")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def export_data_command(self, event: AstrMessageEvent):
+        """将所有数据导出为带缩进的可读 JSON（数据文件使用 compact/msgpack 格式时便于查看与备份）"""
+        await self._ensure_loaded(event)
+        readable = StateSerializer("json")
+        exports = {
+            "cooling_data.json": self._cooling_data_snapshot(),
+            "user_manual_blocked_peer.json": self.manual_blacklist,
+            "breakup_counts.json": self.breakup_counts,
+            "advanced_enabled.json": self.advanced_enabled,
+        }
+        lines = [f"✅ 已导出可读数据到插件目录下的 {EXPORT_DIR.relative_to(PLUGIN_DIR)}/："]
+        try:
+            size = await self._export_pair_data(EXPORT_DIR / "pair_data.json", readable)
+            lines.append(f"▸ pair_data.json（{size / 1024:.1f}KB）")
+            for name, data in exports.items():
+                payload = self.writer.dumps(readable, data)
+                await self.writer.write(EXPORT_DIR / name, payload)
+                lines.append(f"▸ {name}（{len(payload) / 1024:.1f}KB）")
+        except Exception:
+            logger.error(f"导出数据失败: {traceback.format_exc()}")
+            yield event.plain_result("❌ 导出数据失败，请查看日志")
+            return
+        yield event.plain_result("\n".join(lines))
+
+    async def _export_pair_data(self, path: Path, serializer: StateSerializer) -> int:
+        """
+        逐群导出配对数据，同时只在内存中保留一个群的导出内容；未加载的群在线程中直接读取分片，不放入分片缓存。
+        先写入临时文件，全部完成后原子替换。返回写入的字节数。
+        """
+        temp_path = path.with_suffix(".tmp")
+
+        def open_temp():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return open(temp_path, "wb")
+
+        def dump_unloaded(group_id: str) -> bytes:
+            return serializer.dumps({group_id: self.pair_data.read_unloaded(group_id)})
+
+        f = await self.writer.call(path, open_temp)
+        size, done = 0, False
+        try:
+            for group_id in self.pair_data.keys():
+                if self.pair_data.is_loaded(group_id):
+                    payload = self.writer.dumps(serializer, {group_id: self.pair_data[group_id]})
+                else:
+                    payload = await asyncio.to_thread(dump_unloaded, group_id)
+                # 去掉外层的大括号，得到已缩进的 "群号": {...} 片段
+                chunk = (b",\n" if size else b"{\n") + payload[2:-2]
+                await self.writer.call(path, partial(f.write, chunk))
+                size += len(chunk)
+            tail = b"\n}\n" if size else b"{}\n"
+            await self.writer.call(path, partial(f.write, tail))
+            size += len(tail)
+            done = True
+        finally:
+            def finish():
+                f.close()
+                if done:
+                    temp_path.replace(path)
+                else:
+                    temp_path.unlink(missing_ok=True)
+
+            await self.writer.call(path, finish)
+        return size
+
     # --------------- 手动黑名单命令（用户层面） ---------------
     @filter.command("添加黑名单")
     async def add_blacklist_command(self, event: AstrMessageEvent):
@@ -447,31 +2184,24 @@ class DailyWifePlugin(Star):
         示例：添加黑名单 123456 all 双向
         默认：scope=all, two_way=True
         """
+        await self._ensure_loaded(event)
         parts = event.message_str.split()
         if len(parts) < 2 or not parts[1].isdigit():
             yield event.plain_result(
                 "❌ 参数错误\n格式：添加黑名单 [QQ号] [all/群号] [双向/单向]\n例如：添加黑名单 123456 all 双向")
             return
         owner_id = str(event.get_sender_id())
-        blocked_qq = parts[1]
-        scope = "all"
-        two_way = True
-        if len(parts) >= 3:
-            scope_arg = parts[2].strip()
-            if scope_arg != "all" and not scope_arg.isdigit():
-                yield event.plain_result("❌ 第2个参数应为 all 或 群号（数字）。")
-                return
-            scope = scope_arg
-        if len(parts) >= 4:
-            tw = parts[3].strip()
-            if tw in ("双向", "true", "True", "1"):
-                two_way = True
-            elif tw in ("单向", "false", "False", "0"):
-                two_way = False
-            else:
-                yield event.plain_result("❌ 第3个参数应为 双向 或 单向。")
-                return
-        self._add_manual_block(owner_id, blocked_qq, scope=scope, two_way=two_way)
+        parsed, error = self._parse_blacklist_row(parts[1:4])
+        if error:
+            yield event.plain_result(f"❌ {error}。")
+            return
+        blocked_qq, scope, two_way = parsed
+        try:
+            await self._update_global(USER_MANUAL_BLOCKED_PATH, lambda: self._add_manual_block(
+                owner_id, blocked_qq, scope=scope, two_way=two_way, save=False))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
         yield event.plain_result(f"✅ 已为你添加黑名单：{blocked_qq}（范围：{scope}，{'双向' if two_way else '单向'}）")
 
     @filter.command("删除黑名单")
@@ -479,6 +2209,7 @@ class DailyWifePlugin(Star):
         """
         语法：删除黑名单 [QQ号] [all/群号(可选)]
         """
+        await self._ensure_loaded(event)
         parts = event.message_str.split()
         if len(parts) < 2 or not parts[1].isdigit():
             yield event.plain_result("❌ 参数错误\n格式：删除黑名单 [QQ号] [all/群号(可选)]\n例如：删除黑名单 123456 all")
@@ -491,7 +2222,12 @@ class DailyWifePlugin(Star):
             if scope != "all" and not scope.isdigit():
                 yield event.plain_result("❌ 第2个参数应为 all 或 群号（数字）。")
                 return
-        removed = self._remove_manual_block(owner_id, blocked_qq, scope=scope)
+        try:
+            removed = await self._update_global(USER_MANUAL_BLOCKED_PATH, lambda: self._remove_manual_block(
+                owner_id, blocked_qq, scope=scope, save=False))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
         if removed:
             yield event.plain_result(f"✅ 成功删除黑名单：{blocked_qq}（范围：{'所有' if scope is None else scope}）")
         else:
@@ -502,6 +2238,7 @@ class DailyWifePlugin(Star):
         """
         语法：查看黑名单 [可选QQ号，管理员可查看其他人]
         """
+        await self._ensure_loaded(event)
         parts = event.message_str.split()
         requester = str(event.get_sender_id())
         target = requester
@@ -520,16 +2257,121 @@ class DailyWifePlugin(Star):
             lines.append(f"▸ {e['blocked_user']} | 范围: {e['scope']} | {'双向' if e['two_way'] else '单向'}")
         yield event.plain_result("\n".join(lines))
 
+    @filter.command("批量添加黑名单")
+    async def bulk_add_blacklist_command(self, event: AstrMessageEvent):
+        """
+        语法：批量添加黑名单，之后每行（或用分号分隔）一条：[QQ号] [all/群号] [双向/单向]
+        所有条目校验、去重后一次性保存。
+        """
+        await self._ensure_loaded(event)
+        owner_id = str(event.get_sender_id())
+        parts = event.message_str.strip().split(maxsplit=1)
+        rows = [r.split() for r in re.split(r"[\n;；]+", parts[1] if len(parts) > 1 else "") if r.strip()]
+        if not rows:
+            yield event.plain_result(
+                "❌ 参数错误\n格式：批量添加黑名单，之后每行一条 [QQ号] [all/群号] [双向/单向]\n"
+                "例如：\n批量添加黑名单\n123456 all 双向\n234567 10000 单向")
+            return
+        entries = []
+        errors = []
+        for line_no, tokens in enumerate(rows, start=1):
+            parsed, error = self._parse_blacklist_row(tokens)
+            if error:
+                errors.append(f"第{line_no}条：{error}")
+                continue
+            entries.append((owner_id, *parsed))
+        try:
+            added, updated, unchanged = await self._update_global(USER_MANUAL_BLOCKED_PATH,
+                                                                  lambda: self._add_manual_blocks(entries))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
+        lines = [f"✅ 批量添加完成：新增 {added} 条，更新 {updated} 条，未变化 {unchanged} 条"]
+        if errors:
+            lines.append(f"⚠ 以下 {len(errors)} 条格式错误已跳过：")
+            lines.extend(errors[:10])
+            if len(errors) > 10:
+                lines.append(f"……等共 {len(errors)} 条")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("导出黑名单")
+    async def export_blacklist_command(self, event: AstrMessageEvent):
+        """
+        语法：导出黑名单 —— 以 [QQ号] [范围] [双向/单向] 每行一条导出自己的黑名单，可直接用于批量添加
+        管理员使用 导出黑名单 all 时，将所有人的黑名单以 [用户QQ] [QQ号] [范围] [双向/单向] 写入 export/blacklist.txt
+        """
+        await self._ensure_loaded(event)
+        parts = event.message_str.split()
+        if len(parts) >= 2 and parts[1] == "all" and event.is_admin():
+            rows = [f"{owner_id} {self._format_blacklist_row(e)}"
+                    for owner_id, items in self.manual_blacklist.items() for e in items]
+            try:
+                await self.writer.write(EXPORT_DIR / "blacklist.txt", ("\n".join(rows) + "\n").encode("utf-8"))
+            except Exception:
+                logger.error(f"导出黑名单失败: {traceback.format_exc()}")
+                yield event.plain_result("❌ 导出黑名单失败，请查看日志")
+                return
+            yield event.plain_result(f"✅ 已导出 {len(rows)} 条黑名单到 {EXPORT_DIR / 'blacklist.txt'}")
+            return
+        items = self._list_manual_blocks(str(event.get_sender_id()))
+        if not items:
+            yield event.plain_result("ℹ️ 你的黑名单为空。")
+            return
+        yield event.plain_result("\n".join(self._format_blacklist_row(e) for e in items))
+
+    @filter.command("导入黑名单")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def import_blacklist_command(self, event: AstrMessageEvent):
+        """
+        语法：导入黑名单 [文件名(默认 blacklist.txt)]
+        从插件目录 import/ 下读取文件，每行 [用户QQ] [QQ号] [all/群号] [双向/单向]，与 导出黑名单 all 的格式相同。
+        """
+        await self._ensure_loaded(event)
+        parts = event.message_str.split()
+        file_path = IMPORT_DIR / Path(parts[1] if len(parts) >= 2 else "blacklist.txt").name
+        try:
+            content = await asyncio.to_thread(file_path.read_text, encoding="utf-8")
+        except FileNotFoundError:
+            yield event.plain_result(f"❌ 未找到导入文件：{file_path}")
+            return
+        except Exception:
+            logger.error(f"读取黑名单导入文件失败: {traceback.format_exc()}")
+            yield event.plain_result("❌ 读取导入文件失败，请查看日志")
+            return
+        entries = []
+        errors = 0
+        for line in content.splitlines():
+            tokens = line.split()
+            if not tokens or tokens[0].startswith("#"):
+                continue
+            parsed, error = self._parse_blacklist_row(tokens[1:]) if tokens[0].isdigit() else (None, "用户QQ应为数字")
+            if error:
+                errors += 1
+                continue
+            entries.append((tokens[0], *parsed))
+        try:
+            added, updated, unchanged = await self._update_global(USER_MANUAL_BLOCKED_PATH,
+                                                                  lambda: self._add_manual_blocks(entries))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
+        yield event.plain_result(
+            f"✅ 导入完成：新增 {added} 条，更新 {updated} 条，未变化 {unchanged} 条，格式错误 {errors} 行")
+
     # --------------- 核心功能 ---------------
     async def _fetch_avatar(self, user_id: str) -> Optional[Image]:
         """下载用户头像，返回 Image 消息段，失败返回 None。"""
+        data = await self._fetch_avatar_bytes(user_id)
+        return Image.fromBytes(data) if data else None
+
+    async def _fetch_avatar_bytes(self, user_id: str) -> Optional[bytes]:
         avatar_size = self.config.get("avatar_size", 100)
         avatar_url = f"http://q.qlogo.cn/headimg_dl?dst_uin={user_id}&spec={avatar_size}"
         try:
-            async with aiohttp.ClientSession() as session:
+            async with self._outbound_slot("avatar"), aiohttp.ClientSession() as session:
                 async with session.get(avatar_url, timeout=self.timeout) as resp:
                     if resp.status == 200 and 'image' in resp.headers.get('Content-Type', ''):
-                        return Image.fromBytes(await resp.read())
+                        return await resp.read()
                     logger.error(f"下载头像失败，状态码: {resp.status}, Content-Type: {resp.headers.get('Content-Type')}")
         except aiohttp.ClientError as e:
             logger.error(f"下载头像网络错误: {e}")
@@ -539,30 +2381,208 @@ class DailyWifePlugin(Star):
             logger.error(f"处理下载头像异常: {traceback.format_exc()}")
         return None
 
-    async def _get_member_info(self, group_id: str, target_qq: str) -> Tuple[Optional[dict], Optional[str]]:
-        """通过 NapCat API 获取群成员信息（多主机容错）。返回 (data_dict, last_error)。"""
+    def _metric_add(self, name: str, value: float = 1):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+
+    @contextlib.asynccontextmanager
+    async def _outbound_slot(self, kind: str):
+        """出站请求（napcat / avatar）的全局并发上限，超出时排队等待"""
+        semaphore = self._outbound_limits[kind]
+        if semaphore.locked():
+            self._metric_add(f"{kind}_waits")
+        async with semaphore:
+            self._metric_add(f"{kind}_calls")
+            yield
+
+    # --------------- 准入控制 ---------------
+    async def _admission(self, event: AstrMessageEvent, trigger: str, handler):
+        """
+        正则触发命令的准入控制：同一用户的同一命令仍在处理中时直接丢弃重复消息；
+        超出用户或群的频率限制时，有缓存的查询结果则直接返回，否则每次进入限流只提示一次。
+        """
+        group_id = str(getattr(event.message_obj, "group_id", "") or "")
+        user_id = str(event.get_sender_id())
+        key = (group_id, user_id, trigger)
+        if key in self._inflight:
+            self._metric_add("requests_collapsed")
+            return
+        if not self._user_limiter.allow(user_id):
+            self._metric_add("rate_limited_user")
+            reply = self._limited_reply(event, group_id, user_id, trigger, f"user:{user_id}")
+        elif group_id and not self._group_limiter.allow(group_id):
+            self._metric_add("rate_limited_group")
+            reply = self._limited_reply(event, group_id, user_id, trigger, f"group:{group_id}")
+        else:
+            self._limit_notified.discard(f"user:{user_id}")
+            self._limit_notified.discard(f"group:{group_id}")
+            self._inflight.add(key)
+            try:
+                async for result in self._pinned(event, handler):
+                    yield result
+            finally:
+                self._inflight.discard(key)
+            return
+        if reply is not None:
+            yield reply
+
+    def _limited_reply(self, event: AstrMessageEvent, group_id: str, user_id: str, trigger: str, limit_key: str):
+        """
+        被限流时的回复：今日老婆/查询老婆优先返回内存中缓存的查询结果，不产生任何出站请求。
+        今日老婆只使用有伴侣的缓存结果，“还没有伴侣”不能作为抽取的回复。
+        """
+        if trigger in ("draw", "query"):
+            cached = self._cached_reply(group_id, user_id)
+            if cached is not None and (cached[3] or trigger == "query"):
+                self._metric_add("rate_limited_cached_replies")
+                _, text, image, _ = cached
+                return event.chain_result([Plain(text), Image.fromBytes(image)] if image else [Plain(text)])
+        if limit_key in self._limit_notified:
+            return None
+        self._limit_notified.add(limit_key)
+        return event.plain_result(RATE_LIMITED_REPLY)
+
+    async def _partner_image(self, group_id: str, group_data: Dict, user_id: str) -> Optional[Image]:
+        data = await self._partner_image_bytes(group_id, group_data, user_id)
+        return Image.fromBytes(data) if data else None
+
+    async def _partner_image_bytes(self, group_id: str, group_data: Dict, user_id: str) -> Optional[bytes]:
+        return (await self._partner_image_data(group_id, group_data, user_id))[0]
+
+    async def _partner_image_data(self, group_id: str, group_data: Dict, user_id: str) -> Tuple[Optional[bytes], bool]:
+        """
+        配对结果图片：开启 result_card 且已安装 Pillow 时为双方的结果卡片，否则（或渲染失败时）为伴侣头像。
+        返回 (图片字节, 是否为结果卡片)。
+        """
+        partner_id = group_data["pairs"][user_id]["user_id"]
+        if self.config.get("result_card", False) and PILImage is not None:
+            card = await self._pair_card(group_id, group_data, user_id, partner_id)
+            if card:
+                return card, True
+        return await self._fetch_avatar_bytes(partner_id), False
+
+    def _cached_reply(self, group_id: str, user_id: str) -> Optional[Tuple[str, str, Optional[bytes], bool]]:
+        """今天缓存的回复，命中时标记为最近使用"""
+        key = (group_id, user_id)
+        entry = self._reply_cache.get(key)
+        if entry is None or entry[0] != datetime.now().strftime("%Y-%m-%d"):
+            return None
+        self._reply_cache.move_to_end(key)
+        return entry
+
+    def _cache_reply(self, group_id: str, user_id: str, entry: Tuple[str, str, Optional[bytes], bool]):
+        key = (group_id, user_id)
+        self._reply_cache[key] = entry
+        self._reply_cache.move_to_end(key)
+        self._reply_users.setdefault(group_id, set()).add(user_id)
+        if len(self._reply_cache) > REPLY_CACHE_SIZE:
+            self._drop_reply(next(iter(self._reply_cache)))
+
+    def _drop_reply(self, key: Tuple[str, str]):
+        group_id, user_id = key
+        del self._reply_cache[key]
+        users = self._reply_users[group_id]
+        users.discard(user_id)
+        if not users:
+            del self._reply_users[group_id]
+
+    def _invalidate_replies(self, group_id: Optional[str] = None):
+        """配对发生变化时丢弃回复缓存：传入 group_id 时只丢弃该群"""
+        if group_id is None:
+            self._reply_cache.clear()
+            self._reply_users.clear()
+            return
+        for user_id in self._reply_users.pop(group_id, ()):
+            self._reply_cache.pop((group_id, user_id), None)
+
+    async def _pair_card(self, group_id: str, group_data: Dict, user_id: str, partner_id: str) -> Optional[bytes]:
+        """
+        获取配对结果卡片：同一群同一天同一对只渲染一次（双方查询共用），
+        渲染在线程池中进行，不阻塞事件循环。
+        """
+        day = group_data.get("date") or datetime.now().strftime("%Y-%m-%d")
+        user_a, user_b = sorted((user_id, partner_id))
+        key = (group_id, user_a, user_b, day)
+        card = self._card_cache.get(key)
+        if card is not None:
+            self._metric_add("card_cache_hits")
+            return card
+        pairs = group_data["pairs"]
+        names = tuple((_partner_name(pairs.get(other, {})) or uid)[:8]
+                      for uid, other in ((user_a, user_b), (user_b, user_a)))
+        avatars = tuple(await asyncio.gather(self._fetch_avatar_bytes(user_a), self._fetch_avatar_bytes(user_b)))
+        font_path = self.config.get("card_font_path", "")
+
+        def render() -> Tuple[bytes, float]:
+            start = time.perf_counter()
+            data = _render_pair_card(avatars, names, day, font_path)
+            return data, (time.perf_counter() - start) * 1000
+
+        if self._card_executor is None:
+            self._card_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="dailywife-card")
+        try:
+            card, elapsed = await asyncio.get_running_loop().run_in_executor(self._card_executor, render)
+        except Exception:
+            self._metric_add("card_render_failures")
+            logger.error(f"渲染结果卡片失败: {traceback.format_exc()}")
+            return None
+        self._metric_add("card_renders")
+        self._metric_add("card_render_ms_total", elapsed)
+        self.metrics["card_render_ms_max"] = max(self.metrics.get("card_render_ms_max", 0), elapsed)
+        if len(self._card_cache) >= CARD_CACHE_SIZE:
+            del self._card_cache[next(iter(self._card_cache))]
+        self._card_cache[key] = card
+        return card
+
+    @staticmethod
+    def _event_client(event: AstrMessageEvent):
+        """aiocqhttp 事件自带的 OneBot 客户端（即机器人本身的连接），其他平台的事件返回 None"""
+        api = getattr(getattr(event, "bot", None), "api", None)
+        return api if callable(getattr(api, "call_action", None)) else None
+
+    async def _event_client_call(self, client, action: str, params: Dict):
+        """
+        通过事件自带的连接调用 OneBot API，成功时返回响应中的 data；
+        失败时返回 None，由调用方改用配置的 NapCat 主机。
+        """
+        if client is None or not self.config.get("prefer_event_client", True):
+            return None
+        try:
+            async with self._outbound_slot("napcat"):
+                data = await asyncio.wait_for(client.call_action(action, **params), self.timeout)
+        except Exception as e:
+            self._metric_add("napcat_event_client_failures")
+            logger.warning(f"⚠️ 通过当前连接调用 {action} 失败，改用配置的 NapCat 主机: {str(e) or type(e).__name__}")
+            return None
+        self._metric_add("napcat_via_event")
+        return data
+
+    async def _get_member_info(self, group_id: str, target_qq: str,
+                               client=None) -> Tuple[Optional[dict], Optional[str]]:
+        """
+        获取群成员信息：优先通过事件自带的连接（client），不可用时使用配置的 NapCat 主机（多主机容错）。
+        返回 (data_dict, last_error)。
+        """
+        data = await self._event_client_call(client, "get_group_member_info",
+                                             {"group_id": _onebot_id(group_id), "user_id": _onebot_id(target_qq),
+                                              "no_cache": False})
+        if isinstance(data, dict):
+            return data, None
         last_error = None
         for _ in range(len(self.napcat_hosts)):
             host = self._get_current_napcat_host()
             try:
                 logger.info(f"🔍 获取成员信息使用主机: {host}")
-                headers = {"Authorization": f"Bearer {self.config.get('napcat_token', '')}"}
                 payload = {"group_id": group_id, "user_id": target_qq, "no_cache": False}
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                            f"http://{host}/get_group_member_info",
-                            headers=headers, json=payload, timeout=self.timeout
-                    ) as resp:
-                        response_data = await resp.json()
-                        if response_data.get("status") == "failed" and "不存在" in response_data.get("message", ""):
-                            logger.warning(f"⚠️ {host} 报告用户不存在，尝试下一个主机")
-                            last_error = f"{host}: {response_data.get('message')}"
-                            continue
-                        if response_data.get("status") == "ok" and "data" in response_data:
-                            return response_data["data"], None
-                        logger.error(f"Napcat API 错误: {response_data}")
-                        last_error = f"{host}: {response_data}"
-                        continue
+                response_data = await self._napcat_call(host, "get_group_member_info", payload)
+                if response_data.get("status") == "failed" and "不存在" in response_data.get("message", ""):
+                    logger.warning(f"⚠️ {host} 报告用户不存在，尝试下一个主机")
+                    last_error = f"{host}: {response_data.get('message')}"
+                    continue
+                if response_data.get("status") == "ok" and "data" in response_data:
+                    return response_data["data"], None
+                logger.error(f"Napcat API 错误: {response_data}")
+                last_error = f"{host}: {response_data}"
+                continue
             except aiohttp.ClientError as e:
                 logger.error(f"连接 Napcat API 失败: {e}")
                 last_error = f"{host}: {e}"
@@ -574,41 +2594,418 @@ class DailyWifePlugin(Star):
                 last_error = f"{host}: 异常"
         return None, last_error
 
-    async def _get_members(self, group_id: str) -> Optional[List]:
+    async def _get_members(self, group_id: str, client=None) -> Optional[MemberList]:
+        """获取群成员列表：优先通过事件自带的连接（client），不可用时依次尝试配置的 NapCat 主机"""
+        data = await self._event_client_call(client, "get_group_member_list", {"group_id": _onebot_id(group_id)})
+        if isinstance(data, list) and data:
+            members = self._members_from_payload({"data": data})
+            logger.info(f"✅ 通过当前连接获取 {len(members)} 个成员")
+            return members
         for _ in range(len(self.napcat_hosts)):
             host = self._get_current_napcat_host()
             try:
                 logger.info(f"🔍 尝试从 {host} 获取群成员...")
-                headers = {"Authorization": f"Bearer {self.config.get('napcat_token', '')}"}
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                            f"http://{host}/get_group_member_list",
-                            headers=headers, json={"group_id": group_id}, timeout=self.timeout
-                    ) as resp:
-                        data = await resp.json()
-                        if "data" in data and isinstance(data["data"], list):
-                            members = [GroupMember(m) for m in data["data"] if "user_id" in m]
-                            if members:
-                                logger.info(f"✅ {host} 成功获取 {len(members)} 个成员")
-                                return members
-                            logger.warning(f"⚠️ {host} 返回0个成员")
-                        else:
-                            logger.error(f"❌ {host} 返回数据结构异常")
+                fetch_start = time.perf_counter()
+                members = await self._napcat_call(host, "get_group_member_list", {"group_id": group_id},
+                                                  read_http=self._parse_member_list)
+                if isinstance(members, dict):
+                    members = self._members_from_payload(members)
+                fetch_ms = (time.perf_counter() - fetch_start) * 1000
+                if members is None:
+                    logger.error(f"❌ {host} 返回数据结构异常")
+                elif members:
+                    logger.info(f"✅ {host} 成功获取 {len(members)} 个成员（耗时 {fetch_ms:.1f}ms）")
+                    return members
+                else:
+                    logger.warning(f"⚠️ {host} 返回0个成员")
             except Exception as e:
                 logger.error(f"❌ 连接 {host} 失败: {e}")
 
         logger.error("💥 所有主机连接失败")
         return None
 
-    def _check_reset(self, group_id: str):
+    async def _parse_member_list(self, resp: aiohttp.ClientResponse) -> Optional[MemberList]:
+        """
+        解析 get_group_member_list 响应，只保留 user_id / nickname / card。
+        大群（或响应大小未知）且安装了 ijson 时边下载边解析，不在内存中保留完整响应；
+        否则读取完整响应后解析，此时响应中没有 data 列表返回 None。
+        """
+        if ijson is not None and (resp.content_length or MEMBER_LIST_STREAM_THRESHOLD) >= MEMBER_LIST_STREAM_THRESHOLD:
+            members = MemberList()
+            stream = _StreamHead(resp.content, MEMBER_LIST_STREAM_THRESHOLD)
+            async for item in ijson.items_async(stream, "data.item", use_float=True):
+                if isinstance(item, dict):
+                    members.append(item)
+            if len(members):
+                return members
+            # 没有任何成员时用记录下的响应开头区分空列表与缺少 data 的异常响应
+            try:
+                return self._members_from_payload(_json_loads(bytes(stream.head)))
+            except Exception:
+                return None
+        return self._members_from_payload(_json_loads(await resp.read()))
+
+    @staticmethod
+    def _members_from_payload(data: Dict) -> Optional[MemberList]:
+        """从完整的 get_group_member_list 响应构建成员列表，没有 data 列表时返回 None"""
+        if not isinstance(data.get("data"), list):
+            return None
+        members = MemberList()
+        for item in data["data"]:
+            members.append(item)
+        return members
+
+    async def _napcat_call(self, host: str, action: str, params: Dict, read_http: Optional[Callable] = None):
+        """
+        调用 NapCat API。配置了 WebSocket 传输时通过该主机的持久连接发送，返回响应 dict；
+        连接不可用或超时时退回该主机的 HTTP 接口，此时用 read_http(resp) 读取响应（默认解析为 dict）。
+        """
+        ws = self._ws_clients.get(host)
+        if ws is not None:
+            try:
+                async with self._outbound_slot("napcat"):
+                    response = await ws.call(action, params, self.timeout)
+                self._metric_add("napcat_via_ws")
+                return response
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                self._metric_add("napcat_ws_fallbacks")
+                logger.warning(f"⚠️ {host} WebSocket 调用 {action} 失败，改用 HTTP: {str(e) or '超时'}")
+        headers = {"Authorization": f"Bearer {self.config.get('napcat_token', '')}"}
+        async with self._outbound_slot("napcat"), aiohttp.ClientSession() as session:
+            async with session.post(f"http://{host}/{action}", headers=headers, json=params,
+                                    timeout=self.timeout) as resp:
+                self._metric_add("napcat_via_http")
+                return await (read_http(resp) if read_http else resp.json())
+
+    async def _check_reset(self, group_id: str):
         try:
             today = datetime.now().strftime("%Y-%m-%d")
             if group_id not in self.pair_data or self.pair_data[group_id].get("date") != today:
                 self.pair_data[group_id] = {"date": today, "pairs": {}, "used": []}
-                self._save_pair_data()
+                self._eligible_pools.pop(group_id, None)
+                await self._save_pair_data(group_id)
+        except StateConflictError:
+            # 其他实例已先完成当日重置，下次访问时直接读取其版本
+            pass
         except Exception:
             logger.error(f"重置检查失败: {traceback.format_exc()}")
 
+    async def _get_members_cached(self, group_id: str, client=None) -> Optional[MemberList]:
+        """带缓存的群成员列表，缓存时长由 member_cache_seconds 配置（0 表示每次都重新获取）"""
+        ttl = self.config.get("member_cache_seconds", 300)
+        cached = self._member_cache.get(group_id)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        # 同一个群同时只发起一次成员列表请求，并发的调用等待同一结果
+        fetch = self._member_fetches.get(group_id)
+        if fetch is None:
+            fetch = self._member_fetches[group_id] = asyncio.ensure_future(self._get_members(group_id, client))
+            fetch.add_done_callback(lambda _: self._member_fetches.pop(group_id, None))
+        else:
+            self._metric_add("member_fetch_collapsed")
+        members = await asyncio.shield(fetch)
+        if members:
+            self._member_cache[group_id] = (time.monotonic(), members)
+        return members
+
+    def _get_eligible_pool(self, group_id: str, members: MemberList, group_data: Dict, bot_id: str) -> EligiblePool:
+        """获取群候选池，成员列表刷新或日期变化时重建"""
+        pool = self._eligible_pools.get(group_id)
+        if pool is None or pool.members is not members or pool.date != group_data.get("date"):
+            weight_of = None
+            if self.config.get("weighted_selection", False):
+                state = self._selection_state(group_id)
+                today = date.today().toordinal()
+                weight_of = lambda uid: self._member_weight(state, uid, today)
+            pool = EligiblePool(members, group_data, bot_id, weight_of)
+            self._eligible_pools[group_id] = pool
+        return pool
+
+    def _pool_remove(self, group_id: str, *user_ids: str):
+        """成员被配对/使用后从候选池移除"""
+        if group_id in self._eligible_pools:
+            self._eligible_pools[group_id].remove(*user_ids)
+
+    def _pool_restore(self, group_id: str, *user_ids: str):
+        """分手等操作后将成员放回候选池"""
+        if group_id in self._eligible_pools:
+            self._eligible_pools[group_id].restore(*user_ids)
+
+    def _pick_candidate(self, pool: EligiblePool, group_id: str, user_id: str) -> Optional[str]:
+        """
+        从候选池中随机抽取一个对请求者可用的成员（排除自己、冷静期、黑名单）。
+        先随机抽取并拒绝不可用者，多次失败后再遍历候选池，结果在可用成员中均匀分布。
+        """
+        def acceptable(mid: str) -> bool:
+            return (mid != user_id and not self._is_in_cooling_period(user_id, mid)
+                    and not self._is_block_between(user_id, mid, group_id))
+
+        if pool.sampler is not None:
+            return self._pick_weighted_candidate(pool, group_id, user_id, acceptable)
+        for _ in range(POOL_SAMPLE_ATTEMPTS):
+            if not pool.candidates:
+                return None
+            mid = pool.candidates.choice()
+            if acceptable(mid):
+                return mid
+        valid = [mid for mid in pool.candidates if acceptable(mid)]
+        return random.choice(valid) if valid else None
+
+    def _pick_weighted_candidate(self, pool: EligiblePool, group_id: str, user_id: str,
+                                 acceptable: Callable[[str], bool]) -> Optional[str]:
+        """
+        加权抽取：先按成员权重（被抽中越多权重越低）从树状数组中抽取，
+        再以“与请求者最近配对过”的系数做接受/拒绝，结果服从两者乘积的分布。
+        """
+        state = self._selection_state(group_id)
+        today = date.today().toordinal()
+        for _ in range(POOL_SAMPLE_ATTEMPTS):
+            index = pool.sampler.sample()
+            if index is None:
+                return None
+            mid = str(pool.members.user_ids[index])
+            if mid in pool.candidates and acceptable(mid) and \
+                    random.random() < self._partner_factor(state, user_id, mid, today):
+                return mid
+        valid = [mid for mid in pool.candidates if acceptable(mid)]
+        weights = [pool.weight(mid) * self._partner_factor(state, user_id, mid, today) for mid in valid]
+        if not valid:
+            return None
+        if sum(weights) <= 0:
+            return random.choice(valid)
+        return random.choices(valid, weights)[0]
+
+    # --------------- 配对历史 ---------------
+    async def _record_event(self, group_id: str, kind: str, user_id: str, partner_id: str,
+                            user_name: str = "", partner_name: str = "", detail: str = ""):
+        """记录一条事件（kind: draw/group_pair/wish/rob/breakup/lock），见 _record_events"""
+        await self._record_events(group_id, [(kind, str(user_id), str(partner_id), user_name, partner_name, detail)])
+
+    async def _record_events(self, group_id: str, events: List[Tuple[str, str, str, str, str, str]]):
+        """
+        记录同一群的一批事件 (kind, user_id, partner_id, user_name, partner_name, detail)：
+        排行榜统计全部更新后只保存一次，历史写入缓冲，由后台任务批量写入数据库
+        """
+        await self._update_stats(group_id, events)
+        now = datetime.now()
+        timestamp, day = now.timestamp(), now.strftime("%Y-%m-%d")
+        self._history_buffer.extend((timestamp, day, str(group_id), *event) for event in events)
+        if self._history_flush_task is None or self._history_flush_task.done():
+            self._history_flush_task = asyncio.create_task(self._flush_history())
+
+    async def _flush_history(self):
+        async with self._history_lock:
+            rows, self._history_buffer = self._history_buffer, []
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(self.history.append, rows)
+                today = datetime.now().strftime("%Y-%m-%d")
+                if self._history_pruned_day != today:
+                    self._history_pruned_day = today
+                    retention = self.config.get("history_retention_days", 30)
+                    cutoff = (datetime.now() - timedelta(days=retention)).strftime("%Y-%m-%d")
+                    removed = await asyncio.to_thread(self.history.prune, cutoff)
+                    if removed:
+                        logger.info(f"🧹 已清理 {removed} 条超过 {retention} 天的配对历史")
+            except Exception:
+                logger.error(f"写入配对历史失败: {traceback.format_exc()}")
+
+    @filter.command("老婆历史")
+    async def history_command(self, event: AstrMessageEvent):
+        """语法：老婆历史 [N] —— 查看自己在本群最近 N 次配对（默认 10，最多 50）"""
+        await self._ensure_loaded(event)
+        parts = event.message_str.split()
+        limit = min(int(parts[1]), 50) if len(parts) >= 2 and parts[1].isdigit() and int(parts[1]) > 0 else 10
+        group_id = str(event.message_obj.group_id)
+        user_id = str(event.get_sender_id())
+        await self._flush_history()
+        try:
+            rows = await asyncio.to_thread(self.history.recent_partners, group_id, user_id, limit)
+        except Exception:
+            logger.error(f"查询配对历史失败: {traceback.format_exc()}")
+            yield event.plain_result("❌ 查询配对历史失败")
+            return
+        if not rows:
+            yield event.plain_result("🌸 你在本群还没有配对记录哦~")
+            return
+        lines = [f"📜 你最近 {len(rows)} 次配对："]
+        for ts, kind, partner_id, partner_name in rows:
+            when = datetime.fromtimestamp(ts).strftime("%m-%d %H:%M")
+            name = self._format_display_info(partner_name) if partner_name else partner_id
+            lines.append(f"▸ {when} {name}（{HISTORY_PAIR_EVENTS.get(kind, kind)}）")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("配对记录")
+    async def history_by_day_command(self, event: AstrMessageEvent):
+        """语法：配对记录 [YYYY-MM-DD] —— 查看本群某天的配对、分手、强娶、锁定记录（默认今天）"""
+        await self._ensure_loaded(event)
+        parts = event.message_str.split()
+        day = datetime.now().strftime("%Y-%m-%d")
+        if len(parts) >= 2:
+            try:
+                day = datetime.strptime(parts[1], "%Y-%m-%d").strftime("%Y-%m-%d")
+            except ValueError:
+                yield event.plain_result("❌ 日期格式错误，应为 YYYY-MM-DD")
+                return
+        group_id = str(event.message_obj.group_id)
+        await self._flush_history()
+        try:
+            rows = await asyncio.to_thread(self.history.events_on, group_id, day)
+        except Exception:
+            logger.error(f"查询配对记录失败: {traceback.format_exc()}")
+            yield event.plain_result("❌ 查询配对记录失败")
+            return
+        if not rows:
+            yield event.plain_result(f"🌸 本群 {day} 没有配对记录")
+            return
+        lines = [f"📅 本群 {day} 的配对记录（共 {len(rows)} 条）："]
+        for ts, kind, user_id, partner_id, user_name, partner_name, detail in rows[:PAIR_LIST_PAGE_SIZE]:
+            when = datetime.fromtimestamp(ts).strftime("%H:%M")
+            user = self._format_display_info(user_name) if user_name else user_id
+            partner = self._format_display_info(partner_name) if partner_name else partner_id
+            if kind in HISTORY_PAIR_EVENTS:
+                lines.append(f"▸ {when} {user} ❤ {partner}（{HISTORY_PAIR_EVENTS[kind]}）")
+            elif kind == "breakup":
+                lines.append(f"▸ {when} {user} 💔 {partner}（分手）")
+            elif kind == "lock":
+                lines.append(f"▸ {when} {user} 🔒 {partner}（锁定）")
+        if len(rows) > PAIR_LIST_PAGE_SIZE:
+            lines.append(f"……仅显示前 {PAIR_LIST_PAGE_SIZE} 条")
+        yield event.plain_result("\n".join(lines))
+
+    # --------------- 排行榜统计 ---------------
+    def _stats_state(self, group_id: str) -> Dict:
+        if group_id not in self.pair_stats:
+            self.pair_stats[group_id] = {"counters": {}, "top": {}, "streaks": {}}
+        return self.pair_stats[group_id]
+
+    @staticmethod
+    def _stats_set(state: Dict, metric: str, user_id: str, value: int, name: str = ""):
+        """更新用户在某指标上的值并维护该指标的前 K 名（值只增不减，每次 O(K)）"""
+        state["counters"].setdefault(metric, {})[user_id] = value
+        top = state["top"].setdefault(metric, [])
+        for entry in top:
+            if entry[0] == user_id:
+                entry[1] = value
+                entry[2] = name or entry[2]
+                break
+        else:
+            if len(top) >= STATS_TOP_K and value <= top[-1][1]:
+                return
+            top.append([user_id, value, name])
+        top.sort(key=lambda e: -e[1])
+        del top[STATS_TOP_K:]
+
+    def _stats_increment(self, state: Dict, metric: str, user_id: str, name: str = ""):
+        self._stats_set(state, metric, user_id, state["counters"].get(metric, {}).get(user_id, 0) + 1, name)
+
+    def _stats_streak(self, state: Dict, user_id: str, partner_id: str, name: str, today: int):
+        """与同一伴侣连续配对的天数：昨天也是该伴侣则 +1，同一天重复配对不变，否则重新计为 1"""
+        partner, day, length = state["streaks"].get(user_id, ("", 0, 0))
+        if partner == partner_id and day == today:
+            return
+        length = length + 1 if partner == partner_id and day == today - 1 else 1
+        state["streaks"][user_id] = [partner_id, today, length]
+        if length > state["counters"].get("streak", {}).get(user_id, 0):
+            self._stats_set(state, "streak", user_id, length, name)
+
+    async def _update_stats(self, group_id: str, events: List[Tuple[str, str, str, str, str, str]],
+                            retry: bool = True):
+        """在内存中计入一批事件，最后统一保存一次统计分片"""
+        try:
+            state = self._stats_state(group_id)
+            today = date.today().toordinal()
+            for kind, user_id, partner_id, user_name, partner_name, detail in events:
+                if kind in HISTORY_PAIR_EVENTS:
+                    self._stats_streak(state, user_id, partner_id, user_name, today)
+                    self._stats_streak(state, partner_id, user_id, partner_name, today)
+                if kind == "wish":
+                    self._stats_increment(state, "wished", partner_id, partner_name)
+                elif kind == "rob" and detail:
+                    # detail 为被牛走伴侣的一方 名称(QQ号)
+                    robbed_id = _split_display_info(detail)[1]
+                    if robbed_id:
+                        self._stats_increment(state, "robbed", robbed_id, detail)
+                elif kind == "breakup":
+                    self._stats_increment(state, "dumped", partner_id, partner_name)
+            self.pair_stats.mark_dirty(group_id)
+            await self.pair_stats.flush_async(self.writer)
+        except StateConflictError:
+            # 统计为增量更新，可以在其他实例写入的版本上重新计入一次
+            if retry:
+                await self._update_stats(group_id, events, False)
+        except Exception:
+            logger.error(f"更新排行榜统计失败: {traceback.format_exc()}")
+
+    @filter.command("老婆排行")
+    async def leaderboard_command(self, event: AstrMessageEvent):
+        """语法：老婆排行 [被牛/被甩/连续/许愿] —— 不带参数时显示各榜前三"""
+        await self._ensure_loaded(event)
+        group_id = str(event.message_obj.group_id)
+        parts = event.message_str.split()
+        if len(parts) >= 2 and parts[1] not in STATS_METRICS:
+            yield event.plain_result(f"❌ 可选榜单：{' / '.join(STATS_METRICS)}")
+            return
+        selected = [parts[1]] if len(parts) >= 2 else list(STATS_METRICS)
+        limit = STATS_TOP_K if len(selected) == 1 else 3
+        top = self.pair_stats[group_id]["top"] if group_id in self.pair_stats else {}
+        sections = []
+        for arg in selected:
+            metric, title = STATS_METRICS[arg]
+            lines = [f"🏆 {title}"]
+            for rank, (uid, value, name) in enumerate(top.get(metric, [])[:limit], start=1):
+                lines.append(f"{rank}. {self._format_display_info(name) if name else uid} - {value}")
+            if len(lines) == 1:
+                lines.append("暂无数据")
+            sections.append("\n".join(lines))
+        yield event.plain_result("\n\n".join(sections))
+
+    # --------------- 加权抽取 ---------------
+    def _selection_state(self, group_id: str) -> Dict:
+        if group_id not in self.selection_weights:
+            self.selection_weights[group_id] = {"scores": {}, "partners": {}}
+        return self.selection_weights[group_id]
+
+    def _decay(self, days: int) -> float:
+        half_life = max(self.config.get("selection_half_life_days", 3), 1)
+        return 0.5 ** (max(days, 0) / half_life)
+
+    def _member_weight(self, state: Dict, user_id: str, today: int) -> float:
+        """成员基础权重 1 / (1 + 衰减后的被抽中分数)"""
+        score, day = state["scores"].get(user_id, (0.0, today))
+        return 1.0 / (1.0 + score * self._decay(today - day))
+
+    def _partner_factor(self, state: Dict, requester: str, candidate: str, today: int) -> float:
+        """候选人与请求者最近配对过时的降权系数：当天为 0，随时间按半衰期恢复到 1"""
+        day = state["partners"].get(requester, {}).get(candidate)
+        return 1.0 if day is None else 1.0 - self._decay(today - day)
+
+    async def _record_selection(self, group_id: str, pairs: List[Tuple[str, str]]):
+        """记录配对结果（requester, target）：target 的被抽中分数 +1，双方互记为最近伴侣；仅在开启加权抽取时记录"""
+        if not self.config.get("weighted_selection", False):
+            return
+        state = self._selection_state(group_id)
+        today = date.today().toordinal()
+        pool = self._eligible_pools.get(group_id)
+        for requester, target in pairs:
+            score, day = state["scores"].get(target, (0.0, today))
+            state["scores"][target] = [score * self._decay(today - day) + 1.0, today]
+            if pool is not None:
+                pool.set_weight(target, self._member_weight(state, target, today))
+            for a, b in ((requester, target), (target, requester)):
+                partners = state["partners"].setdefault(a, {})
+                partners[b] = today
+                if len(partners) > RECENT_PARTNERS_KEPT:
+                    del partners[min(partners, key=partners.get)]
+        try:
+            self.selection_weights.mark_dirty(group_id)
+            await self.selection_weights.flush_async(self.writer)
+        except StateConflictError as e:
+            logger.warning(f"加权抽取数据写入冲突，本次记录已放弃: {e}")
+        except Exception:
+            logger.error(f"保存加权抽取数据失败: {traceback.format_exc()}")
+
     def _is_advanced_enabled(self, group_id: str) -> bool:
         """
         检查指定群聊的进阶功能是否已开启，会优先判断全局开关。
@@ -622,6 +3019,11 @@ class DailyWifePlugin(Star):
     # --------------- 用户功能 ---------------
     @filter.regex(r"^今日老婆$")  # 或者 filter.command("今日老婆") 取决于你的选择
     async def daily_wife_command(self, event: AstrMessageEvent):
+        async for result in self._admission(event, "draw", self._daily_wife(event)):
+            yield result
+
+    async def _daily_wife(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         if not hasattr(event.message_obj, "group_id"):
             yield event.plain_result("此命令仅限群聊中使用。")
             return
@@ -629,7 +3031,7 @@ class DailyWifePlugin(Star):
             group_id = str(event.message_obj.group_id)
             user_id = str(event.get_sender_id())
             bot_id = str(event.message_obj.self_id)
-            self._check_reset(group_id)
+            await self._check_reset(group_id)
             group_data = self.pair_data.get(group_id,
                                             {"date": datetime.now().strftime("%Y-%m-%d"), "pairs": {}, "used": []})
 
@@ -637,10 +3039,10 @@ class DailyWifePlugin(Star):
             if user_id in group_data.get("pairs", {}):
                 try:
                     partner_info = group_data["pairs"][user_id]
-                    formatted_info = self._format_display_info(partner_info['display_name'])
+                    formatted_info = self._partner_label(partner_info)
                     message_elements = [Plain(f"💖 您的今日伴侣：{formatted_info}\n(请好好对待TA)")]
                     if self.config.get("show_avatar", True):
-                        img = await self._fetch_avatar(partner_info['user_id'])
+                        img = await self._partner_image(group_id, group_data, user_id)
                         message_elements.append(img if img else Plain("\n[头像获取失败]"))
                     yield event.chain_result(message_elements)
                     return
@@ -648,48 +3050,34 @@ class DailyWifePlugin(Star):
                     logger.error(f"获取老婆发生异常: {traceback.format_exc()}")
                     yield event.plain_result("❌ 获取老婆发生异常")
 
-            members = await self._get_members(group_id)
+            members = await self._get_members_cached(group_id, self._event_client(event))
             if not members:
                 yield event.plain_result("⚠️ 当前群组状态异常，请联系管理员")
                 return
 
-            # 过滤候选人：不能是自己、不能是机器人、不能在今日已使用、不能处于冷静期、不能已有伴侣、不能在手动黑名单之内
-            valid_members = []
-            for m in members:
-                mid = str(m.user_id)
-                if mid in {user_id, bot_id}:
-                    continue
-                if mid in group_data.get("used", []):
-                    continue
-                if self._is_in_cooling_period(user_id, mid):
-                    continue
-                if mid in group_data.get("pairs", {}):
-                    continue
-                # 检查手动黑名单（请求者对候选人，或候选人对请求者，或全局排除）
-                if self._is_block_between(user_id, mid, group_id):
-                    continue
-                valid_members.append(m)
-
-            target = None
-            # 尝试选取一个未配对的成员
-            if not valid_members:
+            # 候选池已排除机器人、今日已使用和已配对的成员；抽取时再排除自己、冷静期和手动黑名单
+            pool = self._get_eligible_pool(group_id, members, group_data, bot_id)
+            target_id = self._pick_candidate(pool, group_id, user_id)
+            if target_id is None:
                 yield event.plain_result("😢 暂时找不到合适的人选（可能被屏蔽或都已配对）")
                 return
-
-            # 随机选取
-            target = random.choice(valid_members)
+            target = pool.member(target_id)
 
             # Create a bidirectional pairing
-            sender_display = self._format_display_info(f"{event.get_sender_name()}({user_id})")
-            group_data["pairs"][user_id] = {"user_id": target.user_id, "display_name": target.display_info}
-            group_data["pairs"][target.user_id] = {"user_id": user_id, "display_name": sender_display}
+            group_data["pairs"][user_id] = target.partner_record()
+            group_data["pairs"][target.user_id] = _partner_record(user_id, event.get_sender_name())
             if user_id not in group_data["used"]:
                 group_data["used"].append(user_id)
             if target.user_id not in group_data["used"]:
                 group_data["used"].append(target.user_id)
-            self._save_pair_data()
+            self._pool_remove(group_id, user_id, target.user_id)
+            await self._save_pair_data(group_id)
+            await self._record_selection(group_id, [(user_id, target.user_id)])
+            await self._record_event(group_id, "draw", user_id, target.user_id,
+                                     f"{event.get_sender_name()}({user_id})", target.display_info)
 
-            target_display = self._format_display_info(target.display_info)
+            sender_display = self._partner_label(group_data["pairs"][target.user_id])
+            target_display = self._partner_label(group_data["pairs"][user_id])
 
             message_elements = [
                 Plain(f"恭喜{sender_display}，\n"),
@@ -697,9 +3085,10 @@ class DailyWifePlugin(Star):
             ]
 
             if self.config.get("show_avatar", True):
-                message_elements.append(Plain("▻ 对方头像："))
-                img = await self._fetch_avatar(str(target.user_id))
-                message_elements.append(img if img else Plain("[头像获取失败]"))
+                image, is_card = await self._partner_image_data(group_id, group_data, user_id)
+                if not is_card:
+                    message_elements.append(Plain("▻ 对方头像："))
+                message_elements.append(Image.fromBytes(image) if image else Plain("[头像获取失败]"))
 
             message_elements.extend([
                 Plain("\n💎 好好对待TA哦，\n"),
@@ -708,27 +3097,158 @@ class DailyWifePlugin(Star):
 
             yield event.chain_result(message_elements)
 
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
         except Exception:
             logger.error(f"配对异常: {traceback.format_exc()}")
             yield event.plain_result("❌ 配对过程发生严重异常，请联系开发者")
 
+    @filter.command("全群配对")
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    async def pair_whole_group_command(self, event: AstrMessageEvent):
+        """
+        一次性为群内所有未配对成员随机配对：只获取一次成员列表，对候选池做随机极大匹配
+        （遵守冷静期、手动黑名单和全局排除），所有配对一次性保存。
+        """
+        async for result in self._pinned(event, self._pair_whole_group(event)):
+            yield result
+
+    async def _pair_whole_group(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
+        if not hasattr(event.message_obj, "group_id"):
+            yield event.plain_result("此命令仅限群聊中使用。")
+            return
+        try:
+            group_id = str(event.message_obj.group_id)
+            bot_id = str(event.message_obj.self_id)
+            await self._check_reset(group_id)
+            group_data = self.pair_data[group_id]
+            members = await self._get_members_cached(group_id, self._event_client(event))
+            if not members:
+                yield event.plain_result("⚠️ 当前群组状态异常，请联系管理员")
+                return
+            pool = self._get_eligible_pool(group_id, members, group_data, bot_id)
+            matches = self._random_maximal_matching(pool, group_id)
+            used = set(group_data["used"])
+            for user_a, user_b in matches:
+                group_data["pairs"][user_a] = pool.member(user_b).partner_record()
+                group_data["pairs"][user_b] = pool.member(user_a).partner_record()
+                for uid in (user_a, user_b):
+                    if uid not in used:
+                        used.add(uid)
+                        group_data["used"].append(uid)
+                pool.remove(user_a, user_b)
+            if matches:
+                await self._save_pair_data(group_id)
+                await self._record_selection(group_id, matches)
+                await self._record_events(group_id, [
+                    ("group_pair", user_a, user_b, pool.member(user_a).display_info,
+                     pool.member(user_b).display_info, "")
+                    for user_a, user_b in matches])
+            # 极大匹配结束时只剩 1 人说明人数为奇数，没有可配对的对象；多于 1 人时剩余成员之间互相不可配对
+            left = len(pool.candidates)
+            if left == 1:
+                summary = f"新增 {len(matches)} 对，剩余 1 人因人数为奇数轮空"
+            elif left:
+                summary = f"新增 {len(matches)} 对，{left} 人未能配对"
+            else:
+                summary = f"新增 {len(matches)} 对"
+            yield event.plain_result(f"✅ 全群配对完成：{summary}\n" + self._format_pair_list_page(group_data, 1))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+        except Exception:
+            logger.error(f"全群配对异常: {traceback.format_exc()}")
+            yield event.plain_result("❌ 全群配对过程发生异常")
+
+    def _random_maximal_matching(self, pool: EligiblePool, group_id: str) -> List[Tuple[str, str]]:
+        """
+        在候选池上求随机极大匹配：打乱顺序后每次取出一人，与剩余成员中第一个可配对者配对，
+        找不到则该成员保持未配对。结束时任意两名未配对成员之间都不可配对。
+        """
+        remaining = list(pool.candidates)
+        random.shuffle(remaining)
+        matches = []
+        while remaining:
+            user_a = remaining.pop()
+            for i in range(len(remaining) - 1, -1, -1):
+                user_b = remaining[i]
+                if self._is_in_cooling_period(user_a, user_b) or self._is_block_between(user_a, user_b, group_id):
+                    continue
+                remaining[i] = remaining[-1]
+                remaining.pop()
+                matches.append((user_a, user_b))
+                break
+        return matches
+
+    def _format_pair_list_page(self, group_data: Dict, page: int) -> str:
+        pairs = group_data.get("pairs", {})
+        seen = set()
+        rows = []
+        for uid, info in pairs.items():
+            partner_id = info["user_id"]
+            if uid in seen or partner_id not in pairs:
+                continue
+            seen.update((uid, partner_id))
+            rows.append(f"▸ {self._partner_label(pairs[partner_id])} ❤ {self._partner_label(info)}")
+        if not rows:
+            return "🌸 今日还没有任何配对"
+        total_pages = (len(rows) + PAIR_LIST_PAGE_SIZE - 1) // PAIR_LIST_PAGE_SIZE
+        page = min(max(page, 1), total_pages)
+        start = (page - 1) * PAIR_LIST_PAGE_SIZE
+        lines = [f"💞 今日配对名单（第 {page}/{total_pages} 页，共 {len(rows)} 对）"]
+        lines.extend(rows[start:start + PAIR_LIST_PAGE_SIZE])
+        if page < total_pages:
+            lines.append(f"使用 /配对名单 {page + 1} 查看下一页")
+        return "\n".join(lines)
+
+    @filter.command("配对名单")
+    async def pair_list_command(self, event: AstrMessageEvent):
+        """语法：配对名单 [页码] —— 分页查看本群今日所有配对"""
+        await self._ensure_loaded(event)
+        parts = event.message_str.split()
+        page = int(parts[1]) if len(parts) >= 2 and parts[1].isdigit() else 1
+        group_id = str(event.message_obj.group_id)
+        await self._check_reset(group_id)
+        yield event.plain_result(self._format_pair_list_page(self.pair_data.get(group_id, {}), page))
+
     @filter.regex(r"^查询老婆$")
     async def query_handler(self, event: AstrMessageEvent):
+        async for result in self._admission(event, "query", self._query(event)):
+            yield result
+
+    async def _query(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         try:
             group_id = str(event.message_obj.group_id)
             user_id = event.get_sender_id()
-            self._check_reset(group_id)
+            today = datetime.now().strftime("%Y-%m-%d")
+            cached = self._cached_reply(group_id, user_id)
+            if cached is not None:
+                self._metric_add("reply_cache_hits")
+                _, text, image, _ = cached
+                yield event.chain_result([Plain(text), Image.fromBytes(image)] if image else [Plain(text)])
+                return
+            self._metric_add("reply_cache_misses")
+
+            await self._check_reset(group_id)
             group_data = self.pair_data.get(group_id, {})
             if user_id not in group_data.get("pairs", {}):
+                self._cache_reply(group_id, user_id, (today, "🌸 你还没有伴侣哦~", None, False))
                 yield event.plain_result("🌸 你还没有伴侣哦~")
                 return
             partner_info = group_data["pairs"][user_id]
-            formatted_info = self._format_display_info(partner_info['display_name'])
+            formatted_info = self._partner_label(partner_info)
 
-            message_elements = [Plain(f"💖 您的今日伴侣：{formatted_info}\n(请好好对待TA)")]
+            text = f"💖 您的今日伴侣：{formatted_info}\n(请好好对待TA)"
+            message_elements = [Plain(text)]
+            image = None
             if self.config.get("show_avatar", True):
-                img = await self._fetch_avatar(partner_info['user_id'])
-                message_elements.append(img if img else Plain("\n[头像获取失败]"))
+                image = await self._partner_image_bytes(group_id, group_data, user_id)
+                message_elements.append(Image.fromBytes(image) if image else Plain("\n[头像获取失败]"))
+            # 头像获取失败时不缓存，下次查询重新获取；等待头像期间配对可能已变化，此时也不缓存
+            if (image or not self.config.get("show_avatar", True)) and \
+                    self.pair_data.get(group_id, {}).get("pairs", {}).get(user_id) is partner_info:
+                self._cache_reply(group_id, user_id, (today, text, image, True))
             yield event.chain_result(message_elements)
 
         except Exception:
@@ -737,6 +3257,11 @@ class DailyWifePlugin(Star):
 
     @filter.regex(r"^我要分手$")
     async def divorce_command(self, event: AstrMessageEvent):
+        async for result in self._admission(event, "divorce", self._divorce(event)):
+            yield result
+
+    async def _divorce(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         try:
             group_id = str(event.message_obj.group_id)
             user_id = event.get_sender_id()
@@ -745,6 +3270,7 @@ class DailyWifePlugin(Star):
                 return
             partner_info = self.pair_data[group_id]["pairs"][user_id]
             partner_id = partner_info["user_id"]
+            user_display = _display_info(self.pair_data[group_id]["pairs"].get(partner_id, {}))
             today = datetime.now().strftime("%Y-%m-%d")
             user_counts = self.breakup_counts.get(today, {})
             current_count = user_counts.get(user_id, 0)
@@ -752,8 +3278,10 @@ class DailyWifePlugin(Star):
                 block_hours = self.config["breakup_block_hours"]
                 expire_time = datetime.now() + timedelta(hours=block_hours)
                 # 兼容以前的机制：添加为冷静期阻止
-                self.cooling_data[f"block_{user_id}"] = {"users": [user_id], "expire_time": expire_time}
-                self._save_cooling_data()
+                def add_block():
+                    self.cooling_data[f"block_{user_id}"] = {"users": [user_id], "expire_time": expire_time}
+
+                await self._update_global(COOLING_DATA_PATH, add_block)
                 yield event.chain_result([Plain(
                     f"⚠️ 检测到异常操作：\n▸ 今日已分手 {current_count} 次\n▸ 功能已临时禁用 {block_hours} 小时")])
                 return
@@ -767,16 +3295,26 @@ class DailyWifePlugin(Star):
 
             group_data = self.pair_data[group_id]
             group_data["used"] = [uid for uid in group_data["used"] if uid != user_id and uid != partner_id]
-            self._save_pair_data()
-            cooling_key = f"{user_id}-{partner_id}"
+            self._pool_restore(group_id, user_id, partner_id)
+            await self._save_pair_data(group_id)
+            await self._record_event(group_id, "breakup", user_id, partner_id, user_display, _display_info(partner_info))
             cooling_hours = self.config.get("default_cooling_hours", 48)
-            self.cooling_data[cooling_key] = {"users": [user_id, partner_id],
-                                              "expire_time": datetime.now() + timedelta(hours=cooling_hours)}
-            self._save_cooling_data()
+            expire_time = datetime.now() + timedelta(hours=cooling_hours)
+
+            # 共享模式下冷静期与分手次数在写入冲突时基于其他实例的版本重新计入，确认保存后才回复
+            def add_cooling():
+                self.cooling_data[f"{user_id}-{partner_id}"] = {"users": [user_id, partner_id],
+                                                                "expire_time": expire_time}
+
+            def count_breakup():
+                counts = self.breakup_counts.setdefault(today, {})
+                counts[user_id] = counts.get(user_id, 0) + 1
+
+            await self._update_global(COOLING_DATA_PATH, add_cooling)
+            await self._update_global(BREAKUP_COUNT_PATH, count_breakup)
             yield event.chain_result([Plain(f"💔 您已解除与伴侣的关系\n⏳ {cooling_hours}小时内无法再匹配到一起")])
-            user_counts[user_id] = current_count + 1
-            self.breakup_counts[today] = user_counts
-            self._save_data(BREAKUP_COUNT_PATH, self.breakup_counts)
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
         except Exception:
             logger.error(f"分手异常: {traceback.format_exc()}")
             yield event.plain_result("❌ 分手操作异常")
@@ -785,6 +3323,7 @@ class DailyWifePlugin(Star):
     @filter.command("开启老婆插件进阶功能")
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def enable_advanced_command(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
         user_id = event.get_sender_id()
         if self.advanced_enabled.get(group_id, False):
@@ -800,19 +3339,34 @@ class DailyWifePlugin(Star):
         group_id = str(event.message_obj.group_id)
         if user_id in DailyWifePlugin.ADVANCED_ENABLE_STATES and event.message_str.strip() == "我已知晓进阶功能带来的潜在风险并且执意开启":
             del DailyWifePlugin.ADVANCED_ENABLE_STATES[user_id]
-            self.advanced_enabled[group_id] = True
-            self._save_data(ADVANCED_ENABLED_PATH, self.advanced_enabled)
+            await self._ensure_loaded(event)
+            try:
+                await self._update_global(ADVANCED_ENABLED_PATH, lambda: self._set_advanced_enabled(group_id, True))
+            except StateConflictError:
+                yield event.plain_result(STATE_CONFLICT_REPLY)
+                return
             yield event.plain_result("进阶功能已开启，该群现已启用进阶功能。")
 
     @filter.command("关闭进阶老婆插件功能")
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def disable_advanced_command(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
-        self.advanced_enabled[group_id] = False
-        self._save_data(ADVANCED_ENABLED_PATH, self.advanced_enabled)
+        try:
+            await self._update_global(ADVANCED_ENABLED_PATH, lambda: self._set_advanced_enabled(group_id, False))
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
         yield event.plain_result("进阶功能已关闭，该群已禁用进阶功能。")
 
+    def _set_advanced_enabled(self, group_id: str, enabled: bool):
+        self.advanced_enabled[group_id] = enabled
+
     def _init_advanced_usage(self, group_id: str, user_id: str):
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self._advanced_usage_day != today:
+            self.advanced_usage = {}
+            self._advanced_usage_day = today
         if group_id not in self.advanced_usage:
             self.advanced_usage[group_id] = {}
         if user_id not in self.advanced_usage[group_id]:
@@ -820,6 +3374,11 @@ class DailyWifePlugin(Star):
 
     @filter.command("许愿")
     async def wish_command(self, event: AiocqhttpMessageEvent, input_id: int | None = None):
+        async for result in self._pinned(event, self._wish(event, input_id)):
+            yield result
+
+    async def _wish(self, event: AiocqhttpMessageEvent, input_id: int | None = None):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
         user_id = str(event.get_sender_id())
         if not self._is_advanced_enabled(group_id):
@@ -862,32 +3421,44 @@ class DailyWifePlugin(Star):
             yield event.plain_result("❌ 许愿失败：目标在黑名单或被对方拒绝，无法许愿到该用户。")
             return
 
-        member_data, last_error = await self._get_member_info(group_id, target_qq)
+        member_data, last_error = await self._get_member_info(group_id, target_qq, self._event_client(event))
         if not member_data:
             yield event.plain_result(f"❌ 许愿失败：所有Napcat主机都无法找到该用户\n最后错误: {last_error}")
             return
 
-        target_nickname = member_data.get("nickname", f"未知用户({target_qq})")
-        sender_nickname = event.get_sender_name()
-        group_data["pairs"][user_id] = {"user_id": target_qq, "display_name": f"{target_nickname}({target_qq})"}
-        group_data["pairs"][target_qq] = {"user_id": user_id, "display_name": f"{sender_nickname}({user_id})"}
+        group_data["pairs"][user_id] = _partner_record(target_qq, member_data.get("nickname") or "未知用户",
+                                                       member_data.get("card") or "")
+        group_data["pairs"][target_qq] = _partner_record(user_id, event.get_sender_name())
         if user_id not in group_data["used"]:
             group_data["used"].append(user_id)
         if target_qq not in group_data["used"]:
             group_data["used"].append(target_qq)
-        self._save_pair_data()
+        self._pool_remove(group_id, user_id, target_qq)
+        try:
+            await self._save_pair_data(group_id)
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
+        await self._record_selection(group_id, [(user_id, target_qq)])
+        await self._record_event(group_id, "wish", user_id, target_qq,
+                                 _display_info(group_data["pairs"][target_qq]), _display_info(group_data["pairs"][user_id]))
 
         partner_info = group_data["pairs"][user_id]
-        formatted_info = self._format_display_info(partner_info['display_name'])
+        formatted_info = self._partner_label(partner_info)
         self.advanced_usage[group_id][user_id]["wish"] += 1
         message_elements = [Plain(f"💖 许愿成功,系统已为您指定：{formatted_info}作为伴侣\n(请好好对待TA)")]
         if self.config.get("show_avatar", True):
-            img = await self._fetch_avatar(partner_info['user_id'])
+            img = await self._partner_image(group_id, group_data, user_id)
             message_elements.append(img if img else Plain("\n[头像获取失败]"))
         yield event.chain_result(message_elements)
 
     @filter.command("强娶")
     async def rob_command(self, event: AiocqhttpMessageEvent, input_id: int | None = None):
+        async for result in self._pinned(event, self._rob(event, input_id)):
+            yield result
+
+    async def _rob(self, event: AiocqhttpMessageEvent, input_id: int | None = None):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
         user_id = str(event.get_sender_id())
         if not self._is_advanced_enabled(group_id):
@@ -934,12 +3505,11 @@ class DailyWifePlugin(Star):
             yield event.plain_result("❌ 你已经有伴侣了……强娶将不可用")
             return
 
-        member_data, last_error = await self._get_member_info(group_id, target_qq)
+        member_data, last_error = await self._get_member_info(group_id, target_qq, self._event_client(event))
         if not member_data:
             yield event.plain_result(f"❌ 强娶失败：所有Napcat主机都无法找到该用户\n最后错误: {last_error}")
             return
 
-        target_nickname = member_data.get("nickname", f"未知用户({target_qq})")
         if target_qq not in group_data["pairs"]:
             yield event.plain_result("❌ 强娶失败：目标当前没有伴侣，请改用许愿命令。")
             return
@@ -955,35 +3525,52 @@ class DailyWifePlugin(Star):
 
         # 删除被抢夺者及其原配偶的双向记录
         original_partner_name = "原配"
+        original_partner_id = ""
+        original_partner_display = ""
         if target_qq in group_data["pairs"]:
             original_partner_id = group_data["pairs"][target_qq]["user_id"]
             original_partner_info = group_data["pairs"][target_qq]
-            original_partner_name = self._format_display_info(original_partner_info['display_name'])
+            original_partner_name = self._partner_label(original_partner_info)
+            original_partner_display = _display_info(original_partner_info)
             del group_data["pairs"][target_qq]
             if original_partner_id in group_data["pairs"] and \
                     group_data["pairs"][original_partner_id]["user_id"] == target_qq:
                 del group_data["pairs"][original_partner_id]
 
-        sender_nickname = event.get_sender_name()
-        group_data["pairs"][user_id] = {"user_id": target_qq, "display_name": f"{target_nickname}({target_qq})"}
-        group_data["pairs"][target_qq] = {"user_id": user_id, "display_name": f"{sender_nickname}({user_id})"}
+        group_data["pairs"][user_id] = _partner_record(target_qq, member_data.get("nickname") or "未知用户",
+                                                       member_data.get("card") or "")
+        group_data["pairs"][target_qq] = _partner_record(user_id, event.get_sender_name())
         if user_id not in group_data["used"]:
             group_data["used"].append(user_id)
         if target_qq not in group_data["used"]:
             group_data["used"].append(target_qq)
-        self._save_pair_data()
+        self._pool_remove(group_id, user_id, target_qq)
+        try:
+            await self._save_pair_data(group_id)
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
+        await self._record_selection(group_id, [(user_id, target_qq)])
+        await self._record_event(group_id, "rob", user_id, target_qq,
+                                 _display_info(group_data["pairs"][target_qq]), _display_info(group_data["pairs"][user_id]),
+                                 detail=original_partner_display)
         self.advanced_usage[group_id][user_id]["rob"] += 1
 
         partner_info = group_data["pairs"][user_id]
-        formatted_info = self._format_display_info(partner_info['display_name'])
+        formatted_info = self._partner_label(partner_info)
         message_elements = [Plain(f"🐮 强娶成功,系统已为您牛走了：{original_partner_name}的{formatted_info}作为伴侣")]
         if self.config.get("show_avatar", True):
-            img = await self._fetch_avatar(partner_info['user_id'])
+            img = await self._partner_image(group_id, group_data, user_id)
             message_elements.append(img if img else Plain("\n[头像获取失败]"))
         yield event.chain_result(message_elements)
 
     @filter.command("锁定")
     async def lock_command(self, event: AstrMessageEvent):
+        async for result in self._pinned(event, self._lock(event)):
+            yield result
+
+    async def _lock(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
         if not self._is_advanced_enabled(group_id):
             yield event.plain_result("进阶功能未开启，该群无法使用锁定功能。")
@@ -1006,7 +3593,13 @@ class DailyWifePlugin(Star):
         if partner_id in group_data["pairs"]:
             group_data["pairs"][partner_id]["locked"] = True
         self.pair_data[group_id] = group_data
-        self._save_pair_data()
+        try:
+            await self._save_pair_data(group_id)
+        except StateConflictError:
+            yield event.plain_result(STATE_CONFLICT_REPLY)
+            return
+        await self._record_event(group_id, "lock", user_id, partner_id,
+                                 _display_info(group_data["pairs"].get(partner_id, {})), _display_info(pair_info))
         self.advanced_usage[group_id][user_id]["lock"] += 1
         yield event.plain_result("锁定成功，你与伴侣已被锁定，强娶将无法进行。")
 
@@ -1050,6 +3643,7 @@ class DailyWifePlugin(Star):
     # --------------- 动态菜单 ---------------
     @filter.command("老婆菜单")
     async def menu_handler(self, event: AstrMessageEvent):
+        await self._ensure_loaded(event)
         group_id = str(event.message_obj.group_id)
         is_admin = event.is_admin()  # 判断管理员身份
         adv_enabled = self.advanced_enabled.get(group_id, False)
@@ -1059,7 +3653,11 @@ class DailyWifePlugin(Star):
             "🌸 基础功能(更新为正则触发)：\n"
             "今日老婆 - 随机配对CP\n"
             "查询老婆 - 查询当前CP\n"
-            "我要分手 - 解除当前CP关系\n\n"
+            "我要分手 - 解除当前CP关系\n"
+            "/配对名单 [页码] - 查看本群今日配对\n"
+            "/老婆历史 [N] - 查看自己最近的配对\n"
+            "/配对记录 [日期] - 查看本群某天的记录\n"
+            "/老婆排行 [被牛/被甩/连续/许愿] - 查看排行榜\n\n"
         )
         # 当前配置显示
         config_menu = (
@@ -1093,9 +3691,17 @@ class DailyWifePlugin(Star):
                 "/重置 -b → 手动黑名单\n"
                 "/重置 -d → 分手记录\n"
                 "/重置 -e → 进阶功能状态重置\n"
+                "/导出老婆数据 → 导出可读JSON\n"
+                "/全群配对 → 为所有未配对成员一次性配对\n"
+                "/老婆插件状态 → 查看运行指标\n"
+                "/清理老婆数据 → 立即清理过期数据\n"
+                "/老婆内存占用 → 查看内存占用\n"
                 "/查看黑名单 [QQ号(可选，管理员可查看其他人)]\n"
                 "/添加黑名单 [QQ号] [all/群号] [双向/单向]\n"
                 "/删除黑名单 [QQ号] [all/群号(可选)]\n"
+                "/批量添加黑名单 换行后每行 [QQ号] [all/群号] [双向/单向]\n"
+                "/导出黑名单 [all(管理员导出全部到文件)]\n"
+                "/导入黑名单 [文件名] → 从 import/ 目录导入\n"
                 f"{toggle_cmd}\n\n"
             )
 
@@ -1104,30 +3710,152 @@ class DailyWifePlugin(Star):
         yield event.chain_result([Plain(menu_text.strip())])
 
     # --------------- 定时任务 ---------------
-    async def _daily_reset_task(self):
+    async def _compact_task(self):
+        """启动完成后清理一次，之后每天 00:00:05 清理"""
+        await self._state_loaded.wait()
         while True:
+            try:
+                await self._compact_state()
+            except Exception:
+                logger.error(f"定时任务失败: {traceback.format_exc()}")
             now = datetime.now()
             next_day = now + timedelta(days=1)
             reset_time = datetime(next_day.year, next_day.month, next_day.day, 0, 0, 5)
-            wait_seconds = (reset_time - now).total_seconds()
-            await asyncio.sleep(wait_seconds)
-            try:
-                yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-                if yesterday in self.breakup_counts:
-                    del self.breakup_counts[yesterday]
-                    self._save_data(BREAKUP_COUNT_PATH, self.breakup_counts)
-                now = datetime.now()
-                self.cooling_data = {k: v for k, v in self.cooling_data.items() if
-                                     not (k.startswith("block_") and v["expire_time"] < now)}
-                self._save_cooling_data()
-                self._clean_invalid_cooling_records()
+            await asyncio.sleep((reset_time - now).total_seconds())
+
+    async def _compact_state(self) -> Dict[str, int]:
+        """
+        按保留期清理过期数据，分批进行（批与批之间让出事件循环），全部处理完后统一保存一次：
+        - 超过 state_retention_days 天没有活动的群：配对数据与加权抽取数据
+        - 非今日的分手计数、已过期的冷静期/屏蔽记录、非今日的进阶功能使用计数
+        - 已加载的群中衰减殆尽的加权分数、已中断的连续配对记录
+        - 内存缓存中的过期条目
+        返回 {"groups": 群数, "records": 记录数, "cache": 缓存条目数, "bytes": 回收字节数}。
+        """
+        async with self._compact_lock:
+            start = time.perf_counter()
+            report = {"groups": 0, "records": 0, "cache": 0, "bytes": 0}
+            today = date.today()
+            today_str = today.strftime("%Y-%m-%d")
+            today_ord = today.toordinal()
+            retention = max(self.config.get("state_retention_days", 7), 1)
+            cutoff = (today - timedelta(days=retention)).strftime("%Y-%m-%d")
+
+            # 过期的群：只根据索引中的日期判断，不加载分片；索引中没有日期的群无法判断，一律保留
+            stale = [gid for gid in self.pair_data.keys() if "" < (self.pair_data.date_of(gid) or "") < cutoff]
+            for offset in range(0, len(stale), COMPACT_BATCH_SIZE):
+                batch = stale[offset:offset + COMPACT_BATCH_SIZE]
+                sizes = await asyncio.to_thread(
+                    lambda: {gid: self.pair_data.shard_size(gid) + self.selection_weights.shard_size(gid)
+                             for gid in batch})
+                for gid in batch:
+                    # 等待期间可能重新活跃
+                    if gid not in self.pair_data or not "" < (self.pair_data.date_of(gid) or "") < cutoff:
+                        continue
+                    del self.pair_data[gid]
+                    if gid in self.selection_weights:
+                        del self.selection_weights[gid]
+                    self._eligible_pools.pop(gid, None)
+                    self._member_cache.pop(gid, None)
+                    self._invalidate_replies(gid)
+                    report["groups"] += 1
+                    report["bytes"] += sizes[gid]
+                await asyncio.sleep(0)
+
+            # 已加载群中失效的加权分数与伴侣记录、已中断的连续配对
+            for gid in self.selection_weights.loaded_keys():
+                state = self.selection_weights[gid]
+                removed = 0
+                for uid, (score, day) in list(state["scores"].items()):
+                    if score * self._decay(today_ord - day) < COMPACT_WEIGHT_EPSILON:
+                        del state["scores"][uid]
+                        removed += 1
+                for uid, partners in list(state["partners"].items()):
+                    for partner, day in list(partners.items()):
+                        if self._decay(today_ord - day) < COMPACT_WEIGHT_EPSILON:
+                            del partners[partner]
+                            removed += 1
+                    if not partners:
+                        del state["partners"][uid]
+                if removed:
+                    report["records"] += removed
+                    self.selection_weights.mark_dirty(gid)
+            for gid in self.pair_stats.loaded_keys():
+                streaks = self.pair_stats[gid]["streaks"]
+                ended = [uid for uid, (_, day, _) in streaks.items() if day < today_ord - 1]
+                for uid in ended:
+                    del streaks[uid]
+                if ended:
+                    report["records"] += len(ended)
+                    self.pair_stats.mark_dirty(gid)
+            await asyncio.sleep(0)
+
+            # 全局数据文件
+            now = datetime.now()
+            rewrites = {}
+            stale_dates = [day for day in self.breakup_counts if day != today_str]
+            if stale_dates:
+                report["records"] += sum(len(self.breakup_counts.pop(day)) for day in stale_dates)
+                rewrites[BREAKUP_COUNT_PATH] = self.breakup_counts
+            expired = [k for k, v in self.cooling_data.items() if v["expire_time"] < now]
+            if expired:
+                for k in expired:
+                    del self.cooling_data[k]
+                report["records"] += len(expired)
+                rewrites[COOLING_DATA_PATH] = self._cooling_data_snapshot()
+            if self._advanced_usage_day != today_str:
+                report["records"] += sum(len(users) for users in self.advanced_usage.values())
                 self.advanced_usage = {}
-            except Exception:
-                logger.error(f"定时任务失败: {traceback.format_exc()}")
+                self._advanced_usage_day = today_str
+
+            # 内存缓存
+            ttl = self.config.get("member_cache_seconds", 300)
+            for gid in [g for g, (fetched, _) in self._member_cache.items() if time.monotonic() - fetched >= ttl]:
+                del self._member_cache[gid]
+                report["cache"] += 1
+            for key in [k for k, entry in self._reply_cache.items() if entry[0] != today_str]:
+                self._drop_reply(key)
+                report["cache"] += 1
+            for key in [k for k in self._card_cache if k[3] != today_str]:
+                del self._card_cache[key]
+                report["cache"] += 1
+            report["cache"] += len(self._limit_notified)
+            self._limit_notified.clear()
+
+            # 统一保存一次
+            sizes_before = await asyncio.to_thread(lambda: {p: p.stat().st_size if p.exists() else 0 for p in rewrites})
+            futures = [self._write_state(path, data) for path, data in rewrites.items()]
+            try:
+                await self.pair_data.flush_async(self.writer)
+                await self.selection_weights.flush_async(self.writer)
+                await self.pair_stats.flush_async(self.writer)
+            except StateConflictError as e:
+                logger.warning(f"数据清理时发生写入冲突，相关群将在下次清理时处理: {e}")
+            await asyncio.gather(*futures, return_exceptions=True)
+            sizes_after = await asyncio.to_thread(lambda: {p: p.stat().st_size if p.exists() else 0 for p in rewrites})
+            report["bytes"] += sum(max(sizes_before[p] - sizes_after[p], 0) for p in rewrites)
+
+            self._metric_add("compactions")
+            self._metric_add("compacted_records", report["groups"] + report["records"] + report["cache"])
+            self._metric_add("compacted_bytes", report["bytes"])
+            self._last_compaction = (now.strftime("%Y-%m-%d %H:%M"), report)
+            logger.info(f"🧹 数据清理完成：{report['groups']} 个过期群，{report['records']} 条过期记录，"
+                        f"{report['cache']} 条缓存，回收 {report['bytes'] / 1024:.1f}KB，"
+                        f"耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+            return report
 
     # 插件被禁用、重载或关闭时触发
     async def terminate(self):
         """
         此处实现你的对应逻辑, 例如销毁, 释放某些资源, 回滚某些修改。
         """
-        pass
+        for task in self._background_tasks:
+            task.cancel()
+        await self._flush_history()
+        self.history.close()
+        await self.writer.drain()
+        self.writer.shutdown()
+        for client in self._ws_clients.values():
+            await client.close()
+        if self._card_executor is not None:
+            self._card_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def plugin_dir(tmp_path, monkeypatch):
+    """把插件的所有数据文件路径重定向到临时目录"""
+    main = pytest.importorskip("main")
+    for name in dir(main):
+        value = getattr(main, name)
+        if isinstance(value, Path) and name != "PLUGIN_DIR" and (name.endswith("_PATH") or name.endswith("_DIR")):
+            monkeypatch.setattr(main, name, tmp_path / value.relative_to(main.PLUGIN_DIR))
+    monkeypatch.setattr(main, "PLUGIN_DIR", tmp_path)
+    return tmp_path
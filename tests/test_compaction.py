@@ -0,0 +1,40 @@
+import asyncio
+import json
+import types
+from datetime import date, timedelta
+
+import pytest
+
+pytest.importorskip("astrbot")
+
+import main  # noqa: E402
+
+
+def test_corrupt_index_keeps_active_groups(plugin_dir):
+    today = date.today().strftime("%Y-%m-%d")
+    long_ago = (date.today() - timedelta(days=30)).strftime("%Y-%m-%d")
+    shard_dir = plugin_dir / "pair_data"
+    shard_dir.mkdir()
+    (shard_dir / "100.json").write_text(json.dumps(
+        {"date": today, "pairs": {"1": {"user_id": "2", "nickname": "n2", "card": ""}}, "used": ["1", "2"]}))
+    (shard_dir / "200.json").write_text(json.dumps({"date": long_ago, "pairs": {}, "used": []}))
+    (shard_dir / "index.json").write_text("{corrupt")
+    # 已是最新数据结构：启动时不会执行迁移（迁移会加载所有分片，从而顺带修复索引日期）
+    (plugin_dir / "state_meta.json").write_text(json.dumps({"schema_version": main.SCHEMA_VERSION}))
+
+    async def scenario():
+        plugin = main.DailyWifePlugin(types.SimpleNamespace(), {"state_retention_days": 7})
+        try:
+            await plugin._ensure_loaded()
+            report = await plugin._compact_state()
+            await plugin.writer.drain()
+            return report, plugin.pair_data.keys(), plugin.pair_data.get("100")
+        finally:
+            await plugin.terminate()
+
+    report, groups, active = asyncio.run(scenario())
+    assert report["groups"] == 1
+    assert groups == ["100"]
+    assert active["pairs"]["1"]["user_id"] == "2"
+    assert (shard_dir / "100.json").exists()
+    assert not (shard_dir / "200.json").exists()
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import types
+from datetime import date
+
+import pytest
+
+pytest.importorskip("astrbot")
+pytest.importorskip("fcntl")
+
+import main  # noqa: E402
+
+
+def _write_shard(path, pairs):
+    """模拟另一个实例写入分片：写入临时文件后替换"""
+    temp = path.with_suffix(".tmp")
+    temp.write_text(json.dumps({"date": date.today().strftime("%Y-%m-%d"), "pairs": pairs, "used": list(pairs)}))
+    os.replace(temp, path)
+
+
+def _record(user_id):
+    return {"user_id": user_id, "nickname": f"n{user_id}", "card": ""}
+
+
+@pytest.fixture
+def shard(plugin_dir):
+    shard_dir = plugin_dir / "pair_data"
+    shard_dir.mkdir()
+    path = shard_dir / "100.json"
+    _write_shard(path, {"1": _record("2"), "2": _record("1")})
+    (shard_dir / "index.json").write_text(json.dumps({"groups": {"100": {"date": date.today().strftime("%Y-%m-%d")}}}))
+    (plugin_dir / "state_meta.json").write_text(json.dumps({"schema_version": main.SCHEMA_VERSION}))
+    return path
+
+
+def _run(scenario):
+    async def wrapper():
+        plugin = main.DailyWifePlugin(types.SimpleNamespace(), {"shared_state": True})
+        try:
+            await plugin._ensure_loaded()
+            return await scenario(plugin)
+        finally:
+            await plugin.terminate()
+
+    return asyncio.run(wrapper())
+
+
+def test_save_after_refresh_drops_group_is_conflict(shard):
+    async def scenario(plugin):
+        group_data = plugin.pair_data["100"]
+        _write_shard(shard, {"5": _record("6"), "6": _record("5")})
+        assert await plugin._sync_shared_state() == ["群 100"]
+        group_data["pairs"]["3"] = _record("4")
+        with pytest.raises(main.StateConflictError):
+            await plugin._save_pair_data("100")
+        return plugin.pair_data["100"]
+
+    reloaded = _run(scenario)
+    assert set(reloaded["pairs"]) == {"5", "6"}
+    assert set(json.loads(shard.read_text())["pairs"]) == {"5", "6"}
+
+
+def test_pinned_group_survives_refresh_and_reports_conflict(shard):
+    event = types.SimpleNamespace(message_obj=types.SimpleNamespace(group_id="100"))
+
+    async def scenario(plugin):
+        async def handler():
+            group_data = plugin.pair_data["100"]
+            _write_shard(shard, {"5": _record("6"), "6": _record("5")})
+            # 处理中的群不会被同步丢弃，持有的数据仍是常驻的那一份
+            assert await plugin._sync_shared_state() == []
+            assert plugin.pair_data["100"] is group_data
+            group_data["pairs"]["3"] = _record("4")
+            try:
+                await plugin._save_pair_data("100")
+            except main.StateConflictError:
+                yield "conflict"
+                return
+            yield "saved"
+
+        results = [r async for r in plugin._pinned(event, handler())]
+        await plugin._sync_shared_state()
+        return results, plugin.pair_data["100"]
+
+    results, reloaded = _run(scenario)
+    assert results == ["conflict"]
+    assert set(reloaded["pairs"]) == {"5", "6"}
+    assert set(json.loads(shard.read_text())["pairs"]) == {"5", "6"}
+
+
+class _Event:
+    def __init__(self, message_str, sender_id="1"):
+        self.message_str = message_str
+        self.message_obj = types.SimpleNamespace(group_id="100")
+        self._sender_id = sender_id
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def plain_result(self, text):
+        return text
+
+
+def test_blacklist_add_merges_other_instance_write(shard, plugin_dir):
+    async def scenario(plugin):
+        # 另一个实例在本实例同步之后写入了黑名单
+        path = main.USER_MANUAL_BLOCKED_PATH
+        path.write_text(json.dumps({"9": [{"blocked_user": "8", "scope": "all", "two_way": True}]}))
+        plugin._sync_shared_state = lambda: asyncio.sleep(0, [])
+        replies = [r async for r in plugin.add_blacklist_command(_Event("添加黑名单 123456"))]
+        await plugin.writer.drain()
+        return replies, plugin.manual_blacklist
+
+    replies, blacklist = _run(scenario)
+    assert replies[0].startswith("✅")
+    on_disk = json.loads(main.USER_MANUAL_BLOCKED_PATH.read_text())
+    assert set(on_disk) == set(blacklist) == {"1", "9"}
+    assert on_disk["1"][0]["blocked_user"] == "123456"
+
+
+def test_blacklist_add_reports_unresolved_conflict(shard, plugin_dir):
+    async def scenario(plugin):
+        async def conflict(*args, **kwargs):
+            raise main.StateConflictError([main.USER_MANUAL_BLOCKED_PATH.name])
+
+        plugin._write_state = lambda *args, **kwargs: conflict()
+        return [r async for r in plugin.add_blacklist_command(_Event("添加黑名单 123456"))]
+
+    assert _run(scenario) == [main.STATE_CONFLICT_REPLY]
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import types
+from datetime import date
+
+import pytest
+
+pytest.importorskip("astrbot")
+
+import main  # noqa: E402
+
+
+def _event(group_id):
+    return types.SimpleNamespace(message_obj=types.SimpleNamespace(group_id=group_id))
+
+
+@pytest.fixture
+def groups(plugin_dir):
+    today = date.today().strftime("%Y-%m-%d")
+    shard_dir = plugin_dir / "pair_data"
+    shard_dir.mkdir()
+    for group_id in ("100", "200"):
+        (shard_dir / f"{group_id}.json").write_text(json.dumps({"date": today, "pairs": {}, "used": []}))
+    (shard_dir / "index.json").write_text(json.dumps({"groups": {"100": {"date": today}, "200": {"date": today}}}))
+    (plugin_dir / "state_meta.json").write_text(json.dumps({"schema_version": main.SCHEMA_VERSION}))
+    return shard_dir
+
+
+def _run(scenario):
+    async def wrapper():
+        plugin = main.DailyWifePlugin(types.SimpleNamespace(), {"working_set_max_groups": 1})
+        try:
+            await plugin._ensure_loaded()
+            return await scenario(plugin)
+        finally:
+            await plugin.terminate()
+
+    return asyncio.run(wrapper())
+
+
+def test_group_with_inflight_handler_is_not_evicted(groups):
+    async def scenario(plugin):
+        async def handler():
+            group_data = plugin.pair_data["100"]
+            # 处理中等待出站请求时，另一个群的命令使工作集超出上限
+            await plugin._ensure_loaded(_event("200"))
+            assert plugin.pair_data.is_loaded("100")
+            group_data["pairs"]["1"] = {"user_id": "2", "nickname": "n2", "card": ""}
+            await plugin._save_pair_data("100")
+            yield "saved"
+
+        results = [r async for r in plugin._pinned(_event("100"), handler())]
+        await plugin.writer.drain()
+        # 处理结束后该群可以被换出，重新加载时得到处理中保存的修改
+        await plugin._ensure_loaded(_event("200"))
+        assert not plugin.pair_data.is_loaded("100")
+        loads = plugin.pair_data.loads
+        reloaded = plugin.pair_data["100"]
+        assert plugin.pair_data.loads == loads + 1
+        return results, reloaded
+
+    results, reloaded = _run(scenario)
+    assert results == ["saved"]
+    assert reloaded["pairs"]["1"]["user_id"] == "2"
+    assert "1" in json.loads((groups / "100.json").read_text())["pairs"]
+
+
+def test_save_after_eviction_is_conflict(groups):
+    async def scenario(plugin):
+        group_data = plugin.pair_data["100"]
+        await plugin._ensure_loaded(_event("100"))
+        await plugin._ensure_loaded(_event("200"))
+        assert not plugin.pair_data.is_loaded("100")
+        group_data["pairs"]["1"] = {"user_id": "2", "nickname": "n2", "card": ""}
+        with pytest.raises(main.StateConflictError):
+            await plugin._save_pair_data("100")
+
+    _run(scenario)
+    assert json.loads((groups / "100.json").read_text())["pairs"] == {}
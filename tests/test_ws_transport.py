@@ -0,0 +1,172 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+pytest.importorskip("astrbot")
+web = pytest.importorskip("aiohttp.web")
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+import main  # noqa: E402
+
+
+class NapCatStandIn:
+    """本地 NapCat 替身：/ws 为 OneBot v11 WebSocket 端点，/{action} 为 HTTP 接口"""
+
+    def __init__(self):
+        self.ws_handshakes = 0
+        self.reject_handshakes = 0
+        self.http_calls = []
+        self.sockets = []
+        app = web.Application()
+        app.router.add_get("/ws", self._ws)
+        app.router.add_post("/{action}", self._http)
+        self.server = TestServer(app)
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server.port}"
+
+    @property
+    def ws_url(self):
+        return f"ws://{self.host}/ws"
+
+    async def _ws(self, request):
+        self.ws_handshakes += 1
+        if self.reject_handshakes:
+            self.reject_handshakes -= 1
+            return web.Response(status=503)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        held = []
+        async for msg in ws:
+            call = json.loads(msg.data)
+            action = call["action"]
+            if action == "no_reply":
+                continue
+            if action == "hold":
+                # 先到的调用后回复，验证按 echo 而不是按顺序匹配响应
+                held.append(call)
+                continue
+            if action == "close":
+                await ws.close()
+                break
+            # 通用端点还会推送事件，客户端应忽略
+            await ws.send_str(json.dumps({"post_type": "meta_event"}))
+            for pending in [call] + held[::-1]:
+                await ws.send_str(json.dumps(
+                    {"status": "ok", "data": {"via": "ws", **pending["params"]}, "echo": pending["echo"]}))
+            held.clear()
+        return ws
+
+    async def _http(self, request):
+        params = await request.json()
+        self.http_calls.append(request.match_info["action"])
+        return web.json_response({"status": "ok", "data": {"via": "http", **params}})
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for ws in self.sockets:
+            await ws.close()
+        await self.server.close()
+
+
+def test_concurrent_calls_are_routed_by_echo():
+    async def scenario():
+        async with NapCatStandIn() as napcat:
+            client = main.OneBotWebSocket(napcat.ws_url)
+            try:
+                first = asyncio.create_task(client.call("hold", {"n": 1}, 2))
+                await asyncio.sleep(0.05)
+                second = await client.call("get", {"n": 2}, 2)
+                return (await first)["data"], second["data"], napcat.ws_handshakes
+            finally:
+                await client.close()
+
+    first, second, handshakes = asyncio.run(scenario())
+    assert first == {"via": "ws", "n": 1}
+    assert second == {"via": "ws", "n": 2}
+    assert handshakes == 1
+
+
+def test_call_timeout_keeps_connection():
+    async def scenario():
+        async with NapCatStandIn() as napcat:
+            client = main.OneBotWebSocket(napcat.ws_url)
+            try:
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.call("no_reply", {}, 0.1)
+                response = await client.call("get", {"n": 1}, 2)
+                return response["data"], dict(client.stats), client._pending
+            finally:
+                await client.close()
+
+    data, stats, pending = asyncio.run(scenario())
+    assert data == {"via": "ws", "n": 1}
+    assert stats["timeouts"] == 1 and stats["connects"] == 1
+    assert pending == {}
+
+
+def test_reconnects_after_disconnect_and_backs_off_after_failure():
+    async def scenario():
+        async with NapCatStandIn() as napcat:
+            client = main.OneBotWebSocket(napcat.ws_url)
+            try:
+                # 连接断开时，该连接上等待中的调用立即失败，下一次调用重新连接
+                waiting = asyncio.create_task(client.call("no_reply", {}, 2))
+                await asyncio.sleep(0.05)
+                with pytest.raises(ConnectionError):
+                    await client.call("close", {}, 2)
+                with pytest.raises(ConnectionError):
+                    await waiting
+                assert (await client.call("get", {}, 2))["data"]["via"] == "ws"
+                assert client.stats["connects"] == 2
+
+                # 连接失败后进入退避，退避期间的调用不会再次尝试连接
+                await napcat.sockets[-1].close()
+                await asyncio.sleep(0.05)
+                napcat.reject_handshakes = 1
+                handshakes = napcat.ws_handshakes
+                with pytest.raises(ConnectionError):
+                    await client.call("get", {}, 2)
+                with pytest.raises(ConnectionError, match="正在等待重连"):
+                    await client.call("get", {}, 2)
+                assert napcat.ws_handshakes == handshakes + 1
+                client._retry_at = 0
+                assert (await client.call("get", {}, 2))["data"]["via"] == "ws"
+                return client._failures
+            finally:
+                await client.close()
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_napcat_call_falls_back_to_http(plugin_dir):
+    async def scenario():
+        async with NapCatStandIn() as napcat:
+            plugin = main.DailyWifePlugin(types.SimpleNamespace(), {
+                "napcat_host": napcat.host,
+                "napcat_transport": "websocket",
+                "napcat_ws_hosts": napcat.ws_url,
+                "request_timeout": 0.5,
+            })
+            try:
+                via_ws = await plugin._napcat_call(napcat.host, "get", {"n": 1})
+                # WebSocket 超时时改用同一主机的 HTTP 接口
+                via_http = await plugin._napcat_call(napcat.host, "no_reply", {"n": 2})
+                return via_ws["data"], via_http["data"], napcat.http_calls, dict(plugin.metrics)
+            finally:
+                await plugin.terminate()
+
+    via_ws, via_http, http_calls, metrics = asyncio.run(scenario())
+    assert via_ws == {"via": "ws", "n": 1}
+    assert via_http == {"via": "http", "n": 2}
+    assert http_calls == ["no_reply"]
+    assert metrics["napcat_via_ws"] == 1
+    assert metrics["napcat_ws_fallbacks"] == 1
+    assert metrics["napcat_via_http"] == 1